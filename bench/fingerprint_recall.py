@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Recall check for the watcher's fingerprint index.
+
+Indexes random fingerprints in the in-memory Redis stand-in, then looks up
+copies of some of them with every bit flipped with probability --ber and a
+random misalignment of up to FINGERPRINT_MAX_OFFSET sub-fingerprints. Reports
+how often the original comes back as a candidate, and how many random tracks
+ride along. The default --ber sits at FINGERPRINT_MATCH_THRESHOLD, the worst
+pair a lookup still has to find.
+
+    python bench/fingerprint_recall.py --library 5000 --queries 200
+"""
+import argparse
+import random
+import sys
+import tempfile
+
+from run_benchmark import load_stage
+
+
+def noisy_copy(fingerprint, ber, shift, rng):
+    """fingerprint with each bit flipped with probability ber, moved shift sub-fingerprints later."""
+    copy = []
+    for value in fingerprint:
+        for bit in range(32):
+            if rng.random() < ber:
+                value ^= 1 << bit
+        copy.append(value)
+    if shift > 0:
+        return [rng.getrandbits(32) for _ in range(shift)] + copy
+    return copy[-shift:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--library", type=int, default=2000, help="fingerprints in the index")
+    parser.add_argument("--queries", type=int, default=200, help="noisy lookups of indexed fingerprints")
+    parser.add_argument("--ber", type=float, help="bit error rate of the lookups (default: 1 - FINGERPRINT_MATCH_THRESHOLD)")
+    parser.add_argument("--words", type=int, default=960, help="sub-fingerprints per track (~8 per second)")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="exit non-zero below this recall")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        watcher = load_stage("watcher", workdir)
+    ber = args.ber if args.ber is not None else 1.0 - watcher.FINGERPRINT_MATCH_THRESHOLD
+    rng = random.Random(args.seed)
+
+    library = [[rng.getrandbits(32) for _ in range(args.words)] for _ in range(args.library)]
+    for i, fingerprint in enumerate(library):
+        watcher.index_fingerprint(f"track-{i}", 0.0, fingerprint)
+
+    found = 0
+    false_candidates = 0
+    for i in rng.sample(range(args.library), min(args.queries, args.library)):
+        shift = rng.randint(-watcher.FINGERPRINT_MAX_OFFSET, watcher.FINGERPRINT_MAX_OFFSET)
+        candidates = watcher.fingerprint_candidates(noisy_copy(library[i], ber, shift, rng))
+        found += f"track-{i}" in candidates
+        false_candidates += len(candidates) - (f"track-{i}" in candidates)
+
+    queries = min(args.queries, args.library)
+    recall = found / queries
+    print(f"bands={watcher.FINGERPRINT_BANDS} bits/band={watcher.FINGERPRINT_BAND_BITS} "
+          f"min_hits={watcher.FINGERPRINT_MIN_HITS} library={args.library} ber={ber:.3f}")
+    print(f"recall: {found}/{queries} ({recall:.1%}), false candidates per lookup: {false_candidates / queries:.2f}")
+    return 0 if recall >= args.min_recall else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
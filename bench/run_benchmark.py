@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+"""
+Offline end-to-end benchmark for the pipeline.
+
+Generates tagged synthetic MP3s and pushes them through the real stage code
+(watcher or queue, splitter, converter, combiner, metadata, cleanup) inside
+one process. RabbitMQ and Redis are replaced by the in-memory stand-ins in
+bench/standins, and so is Spleeter, which writes decoded copies of the input
+instead of running the model. ffmpeg must be on PATH.
+
+    python bench/run_benchmark.py --tracks 24 --durations 15,30,180
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, "standins"))
+sys.path.insert(1, os.path.join(REPO_ROOT, "shared"))  # the kip helper package
+
+import aio_pika  # noqa: E402  (the stand-ins, not the real clients)
+import pika  # noqa: E402
+from mutagen.easyid3 import EasyID3  # noqa: E402
+from mutagen.mp3 import MP3  # noqa: E402
+from prometheus_client import REGISTRY  # noqa: E402
+from kip import admission, profiling  # noqa: E402
+
+logger = logging.getLogger("benchmark")
+
+# Consumed queues, most downstream first: draining the tail first keeps scratch
+# usage bounded, the same way the real stages run concurrently.
+STAGE_QUEUES = [
+    ("cleanup", "cleanup_jobs"),
+    ("metadata", "metadata_jobs"),
+    ("combiner", "combiner_jobs"),
+    ("converter", "converter_jobs"),
+    ("splitter", "splitter_jobs"),
+]
+
+
+def load_stage(name, workdir):
+    """Import <name>/main.py as its own module, the way its container would run it."""
+    os.environ["PENDING_INDEX_FILE"] = os.path.join(workdir, f".{name}_pending.json")
+    spec = importlib.util.spec_from_file_location(f"kip_{name}", os.path.join(REPO_ROOT, name, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    profiling.PROFILE_DIR = os.path.join(workdir, "profiles")
+    # Every service registers the same kip_* metric names; in production each
+    # lives in its own process, here they would collide in the default registry.
+    for collector in list(REGISTRY._collector_to_names):
+        REGISTRY.unregister(collector)
+    return module
+
+
+def load_stages(workdir, entry):
+    dirs = {name: os.path.join(workdir, name) for name in ("downloads", "originals", "pipeline", "splitter_output", "music")}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+
+    admission.SPLITTER_OUTPUT_DIR = dirs["splitter_output"]
+    stages = {}
+    if entry == "watcher":
+        watcher = load_stage("watcher", workdir)
+        watcher.WATCH_DIR = dirs["downloads"]
+        watcher.ORIGINALS_DIR = dirs["originals"]
+        watcher.MUSIC_DIR = dirs["music"]
+        watcher.STABILITY_TIME = 0
+        stages["watcher"] = watcher
+    # Loaded for the watcher entry too: full renders of previews go through its pending index.
+    queue = load_stage("queue", workdir)
+    queue.PIPELINE_DIR = dirs["pipeline"]
+    stages["queue"] = queue
+
+    splitter = load_stage("splitter", workdir)
+    splitter.OUTPUT_DIR = dirs["splitter_output"]
+    splitter.ORIGINALS_DIR = dirs["originals"]
+    stages["splitter"] = splitter
+
+    stages["converter"] = load_stage("converter", workdir)
+
+    combiner = load_stage("combiner", workdir)
+    combiner.MUSIC_DIR = dirs["music"]
+    stages["combiner"] = combiner
+
+    metadata = load_stage("metadata", workdir)
+    metadata.MUSIC_DIR = dirs["music"]
+    stages["metadata"] = metadata
+    stages["cleanup"] = load_stage("cleanup", workdir)
+    return stages, dirs
+
+
+def generate_tracks(target_dir, count, durations):
+    """Write count tagged sine-wave MP3s, cycling through durations (seconds)."""
+    paths = []
+    for i in range(count):
+        duration = durations[i % len(durations)]
+        path = os.path.join(target_dir, f"bench_{i:04d}.mp3")
+        cmd = [
+            "ffmpeg", "-y", "-f", "lavfi", "-i", f"sine=frequency={220 + 10 * i}:duration={duration}",
+            "-ac", "2", "-ar", "44100", "-b:a", "192k", path,
+        ]
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        audio = MP3(path, ID3=EasyID3)
+        if audio.tags is None:
+            audio.add_tags()
+        audio["title"] = f"Bench Track {i:04d}"
+        audio["artist"] = "Benchmark"
+        audio["album"] = "Synthetic"
+        audio.save()
+        paths.append(path)
+    return paths
+
+
+def directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def music_tracks(path):
+    """Finished tracks in the music folder (hidden files are renders in progress)."""
+    return [f for f in os.listdir(path) if f.endswith(".mp3") and not f.startswith(".")]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def run_pipeline(stages, dirs, sources):
+    latencies = {name: [] for name in ["watcher", "queue"] + [s for s, _ in STAGE_QUEUES]}
+    queue_waits = {name: [] for name, _ in STAGE_QUEUES}
+    peak_scratch = 0
+    first_result = None
+    entry = "watcher" if "watcher" in stages else "queue"
+
+    started = time.monotonic()
+    for source in sources:
+        if entry == "watcher":
+            path = shutil.copy(source, dirs["downloads"])
+            t0 = time.perf_counter()
+            stages["watcher"].DownloadHandler().handle_file(path)
+        else:
+            path = shutil.copy(source, dirs["pipeline"])
+            t0 = time.perf_counter()
+            stages["queue"].send_to_queue({"type": "track", "path": path})
+        latencies[entry].append(time.perf_counter() - t0)
+
+    pending_indexes = [stages[name].pending_index for name in dict.fromkeys([entry, "queue"])]
+    while True:
+        for name, queue in STAGE_QUEUES:
+            message = pika.get(queue)
+            if message:
+                break
+        else:
+            stages["queue"].pending_index.take_full_renders()
+            if any(index.count() and index.release() for index in pending_indexes):
+                continue
+            held = sum(index.count() for index in pending_indexes)
+            if held:
+                logger.warning("Admission control is holding %d jobs with empty queues; stopping.", held)
+            break
+
+        method, properties, body, waited = message
+        t0 = time.perf_counter()
+        if getattr(stages[name], "BATCH_SIZE", 1) > 1:
+            # batch mode: take whatever else is queued, up to the batch size
+            batch = [(method, body, waited)]
+            while len(batch) < stages[name].BATCH_SIZE:
+                extra = pika.get(queue)
+                if not extra:
+                    break
+                batch.append((extra[0], extra[2], extra[3]))
+            incoming = [aio_pika.IncomingMessage(b, m.delivery_tag) for m, b, _ in batch]
+            asyncio.run(stages[name].process_batch(incoming, aio_pika.Channel()))
+            elapsed_batch = time.perf_counter() - t0
+            latencies[name].extend([elapsed_batch] * len(batch))
+            queue_waits[name].extend(w for _, _, w in batch)
+            peak_scratch = max(peak_scratch, directory_bytes(dirs["splitter_output"]))
+            if first_result is None and music_tracks(dirs["music"]):
+                first_result = time.monotonic() - started
+            continue
+        if hasattr(stages[name], "handle_message"):
+            # asyncio consumer (metadata, cleanup)
+            incoming = aio_pika.IncomingMessage(body, method.delivery_tag)
+            asyncio.run(stages[name].handle_message(incoming, aio_pika.Channel()))
+        else:
+            channel = pika.BlockingConnection().channel()
+            stages[name].callback(channel, method, properties, body)
+        if name == "cleanup":
+            # cleanup only finalises the job; the artifact GC does the deleting
+            asyncio.run(stages["cleanup"].gc_pass())
+        latencies[name].append(time.perf_counter() - t0)
+        queue_waits[name].append(waited)
+        peak_scratch = max(peak_scratch, directory_bytes(dirs["splitter_output"]))
+        if first_result is None and music_tracks(dirs["music"]):
+            first_result = time.monotonic() - started
+
+    elapsed = time.monotonic() - started
+    return elapsed, latencies, queue_waits, peak_scratch, first_result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tracks", type=int, default=12, help="number of synthetic tracks")
+    parser.add_argument("--durations", default="10,30,90", help="comma-separated track lengths in seconds, cycled")
+    parser.add_argument("--entry", choices=["watcher", "queue"], default="watcher", help="ingest stage to drive")
+    parser.add_argument("--workdir", help="scratch directory (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--json", dest="json_path", help="also write the results to this file")
+    parser.add_argument("--metadata-batch", type=int, default=1, help="metadata stage batch size (1 disables batch mode)")
+    parser.add_argument("--preview", type=int, metavar="SECONDS", help="enable preview-first rendering with this excerpt length")
+    parser.add_argument("--profile", action="store_true", help="profile every job (artifacts go to <workdir>/profiles)")
+    parser.add_argument("--verbose", action="store_true", help="show the stages' own log output")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+        logger.setLevel(logging.INFO)
+    if not shutil.which("ffmpeg"):
+        parser.error("ffmpeg must be on PATH")
+
+    # The stand-in disk is usually a laptop SSD; do not let the production
+    # scratch reserve stall the run.
+    admission.MIN_FREE_SCRATCH_BYTES = int(os.getenv("MIN_FREE_SCRATCH_MB", "0")) * 1024 * 1024
+    os.environ.setdefault("GC_MAX_MB_PER_SECOND", "0")
+    # Every synthetic track is a sine wave, so they would all fingerprint alike.
+    os.environ.setdefault("FINGERPRINT_ENABLED", "false")
+    profiling.PROFILE_ALL_JOBS = args.profile
+    if args.preview:
+        os.environ["PREVIEW_ENABLED"] = "true"
+        os.environ["PREVIEW_SECONDS"] = str(args.preview)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="kip-bench-")
+    try:
+        stages, dirs = load_stages(workdir, args.entry)
+        stages["metadata"].BATCH_SIZE = args.metadata_batch
+        durations = [float(d) for d in args.durations.split(",")]
+        source_dir = os.path.join(workdir, "sources")
+        os.makedirs(source_dir, exist_ok=True)
+        logger.info("Generating %d synthetic tracks in %s...", args.tracks, source_dir)
+        sources = generate_tracks(source_dir, args.tracks, durations)
+
+        elapsed, latencies, queue_waits, peak_scratch, first_result = run_pipeline(stages, dirs, sources)
+        produced = music_tracks(dirs["music"])
+        self_usage = resource.getrusage(resource.RUSAGE_SELF)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        results = {
+            "tracks": args.tracks,
+            "produced": len(produced),
+            "elapsed_seconds": elapsed,
+            "tracks_per_hour": len(produced) / elapsed * 3600 if elapsed else 0.0,
+            "first_result_seconds": first_result,
+            "stages": {
+                name: {
+                    "jobs": len(values),
+                    "p50_seconds": percentile(values, 50),
+                    "p99_seconds": percentile(values, 99),
+                    "queue_wait_p50_seconds": percentile(queue_waits.get(name, []), 50),
+                    "queue_wait_p99_seconds": percentile(queue_waits.get(name, []), 99),
+                }
+                for name, values in latencies.items() if values
+            },
+            # ru_maxrss is in kilobytes on Linux. For RUSAGE_CHILDREN it is the
+            # peak of the largest single child, and a child's peak includes the
+            # benchmark memory it was forked with before exec'ing ffmpeg. It is
+            # an upper bound for one ffmpeg process, not the children's total.
+            "peak_rss_bytes": self_usage.ru_maxrss * 1024,
+            "largest_child_rss_upper_bound_bytes": child_usage.ru_maxrss * 1024,
+            "peak_scratch_bytes": peak_scratch,
+            "music_bytes": directory_bytes(dirs["music"]),
+            "leftover_scratch_bytes": directory_bytes(dirs["splitter_output"]),
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"tracks: {results['produced']}/{results['tracks']} in {results['elapsed_seconds']:.1f}s "
+          f"({results['tracks_per_hour']:.0f} tracks/hour), first result after {results['first_result_seconds'] or 0:.1f}s")
+    print(f"{'stage':<10} {'jobs':>5} {'p50 s':>8} {'p99 s':>8} {'wait p50':>9} {'wait p99':>9}")
+    for name, stats in results["stages"].items():
+        print(f"{name:<10} {stats['jobs']:>5} {stats['p50_seconds']:>8.3f} {stats['p99_seconds']:>8.3f} "
+              f"{stats['queue_wait_p50_seconds']:>9.3f} {stats['queue_wait_p99_seconds']:>9.3f}")
+    print(f"peak RSS: {results['peak_rss_bytes'] / 2**20:.1f} MiB "
+          f"(largest child, upper bound: {results['largest_child_rss_upper_bound_bytes'] / 2**20:.1f} MiB)")
+    print(f"disk: peak scratch {results['peak_scratch_bytes'] / 2**20:.1f} MiB, "
+          f"music {results['music_bytes'] / 2**20:.1f} MiB, "
+          f"left in scratch {results['leftover_scratch_bytes'] / 2**20:.1f} MiB")
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
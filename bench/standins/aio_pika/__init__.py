@@ -0,0 +1,82 @@
+"""
+In-memory stand-in for the parts of aio-pika the asyncio stages use.
+
+Publishing goes through the pika stand-in, so both kinds of stage share the
+same queues. Deliveries are not pushed to consumers; the benchmark pulls them
+with pika.get() and wraps each one in an IncomingMessage.
+"""
+import enum
+
+import pika
+
+
+class DeliveryMode(enum.IntEnum):
+    NOT_PERSISTENT = 1
+    PERSISTENT = 2
+
+
+class Message:
+    def __init__(self, body, delivery_mode=None, priority=None, **kwargs):
+        self.body = body
+        self.delivery_mode = delivery_mode
+        self.priority = priority
+
+
+class IncomingMessage:
+    def __init__(self, body, delivery_tag):
+        self.body = body
+        self.delivery_tag = delivery_tag
+        self.state = "pending"
+
+    async def ack(self, multiple=False):
+        self.state = "acked"
+
+    async def nack(self, multiple=False, requeue=True):
+        self.state = "nacked"
+
+    async def reject(self, requeue=False):
+        self.state = "rejected"
+
+
+class Exchange:
+    async def publish(self, message, routing_key, **kwargs):
+        properties = pika.BasicProperties(delivery_mode=message.delivery_mode, priority=message.priority)
+        pika.BlockingChannel().basic_publish("", routing_key, message.body, properties)
+
+
+class Queue:
+    def __init__(self, name):
+        self.name = name
+
+    async def consume(self, callback, **kwargs):
+        raise NotImplementedError("The stand-in broker is driven with pika.get(), not consume().")
+
+    async def cancel(self, consumer_tag):
+        pass
+
+
+class Channel:
+    def __init__(self):
+        self.default_exchange = Exchange()
+
+    async def set_qos(self, prefetch_count=0, **kwargs):
+        pass
+
+    async def declare_queue(self, name, durable=False, **kwargs):
+        pika.BlockingChannel().queue_declare(name, durable=durable)
+        return Queue(name)
+
+    async def close(self):
+        pass
+
+
+class RobustConnection:
+    async def channel(self):
+        return Channel()
+
+    async def close(self):
+        pass
+
+
+async def connect_robust(url=None, **kwargs):
+    return RobustConnection()
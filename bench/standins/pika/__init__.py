@@ -0,0 +1,113 @@
+"""
+In-memory stand-in for the parts of pika the pipeline services use.
+
+All connections share one set of queues, so a message published by one stage
+can be pulled with get() and handed to the next stage's callback. Messages are
+returned highest priority first, like a RabbitMQ queue declared with
+x-max-priority.
+"""
+import heapq
+import itertools
+import time
+from types import SimpleNamespace
+
+from . import exceptions
+
+_queues = {}
+_sequence = itertools.count()
+
+
+class PlainCredentials:
+    def __init__(self, username, password, erase_on_connect=False):
+        self.username = username
+        self.password = password
+
+
+class ConnectionParameters:
+    def __init__(self, host=None, port=None, credentials=None, **kwargs):
+        self.host = host
+        self.port = port
+        self.credentials = credentials
+
+
+class BasicProperties:
+    def __init__(self, delivery_mode=None, priority=None, **kwargs):
+        self.delivery_mode = delivery_mode
+        self.priority = priority
+
+
+class BlockingChannel:
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+        self.is_open = True
+
+    def queue_declare(self, queue, passive=False, durable=False, arguments=None, **kwargs):
+        if passive and queue not in _queues:
+            self.is_open = False
+            raise exceptions.ChannelClosedByBroker(404, f"NOT_FOUND - no queue '{queue}'")
+        messages = _queues.setdefault(queue, [])
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=len(messages)))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if isinstance(body, str):
+            body = body.encode()
+        priority = (properties.priority if properties else None) or 0
+        entry = (-priority, next(_sequence), time.monotonic(), body, properties)
+        heapq.heappush(_queues.setdefault(routing_key, []), entry)
+
+    def confirm_delivery(self):
+        pass  # publishes land in the in-memory queue synchronously
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        pass
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False, **kwargs):
+        _queues.setdefault(queue, [])
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acked.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacked.append((delivery_tag, multiple, requeue))
+
+    def start_consuming(self):
+        raise NotImplementedError("The stand-in broker is driven with pika.get(), not start_consuming().")
+
+    def stop_consuming(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class BlockingConnection:
+    def __init__(self, parameters=None):
+        self.is_open = True
+
+    def channel(self):
+        return BlockingChannel()
+
+    def close(self):
+        self.is_open = False
+
+
+def get(queue):
+    """
+    Pop the next message from queue. Returns (method, properties, body,
+    seconds spent in the queue), or None when the queue is empty.
+    """
+    messages = _queues.get(queue)
+    if not messages:
+        return None
+    _, tag, published_at, body, properties = heapq.heappop(messages)
+    method = SimpleNamespace(delivery_tag=tag, routing_key=queue)
+    return method, properties or BasicProperties(), body, time.monotonic() - published_at
+
+
+def depth(queue):
+    return len(_queues.get(queue, []))
+
+
+def reset():
+    _queues.clear()
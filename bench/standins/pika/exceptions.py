@@ -0,0 +1,13 @@
+class AMQPError(Exception):
+    pass
+
+
+class AMQPConnectionError(AMQPError):
+    pass
+
+
+class ChannelClosedByBroker(AMQPError):
+    def __init__(self, reply_code, reply_text):
+        super().__init__(reply_code, reply_text)
+        self.reply_code = reply_code
+        self.reply_text = reply_text
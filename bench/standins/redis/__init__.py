@@ -0,0 +1,144 @@
+"""
+In-memory stand-in for the redis-py calls the pipeline services make.
+
+Every client shares one keyspace, like several containers talking to the same
+Redis server. Values are stored as strings, matching decode_responses=True.
+"""
+_data = {}
+
+
+class StrictRedis:
+    def __init__(self, host=None, port=None, decode_responses=False, **kwargs):
+        self._data = _data
+
+    def get(self, name):
+        return self._data.get(name)
+
+    def set(self, name, value):
+        self._data[name] = str(value)
+        return True
+
+    def hset(self, name, key=None, value=None, mapping=None):
+        fields = self._data.setdefault(name, {})
+        items = dict(mapping or {})
+        if key is not None:
+            items[key] = value
+        added = sum(1 for k in items if k not in fields)
+        fields.update({k: str(v) for k, v in items.items()})
+        return added
+
+    def hget(self, name, key):
+        return self._data.get(name, {}).get(key)
+
+    def hgetall(self, name):
+        return dict(self._data.get(name, {}))
+
+    def hvals(self, name):
+        return list(self._data.get(name, {}).values())
+
+    def hdel(self, name, *keys):
+        fields = self._data.get(name, {})
+        return sum(1 for k in keys if fields.pop(k, None) is not None)
+
+    def sadd(self, name, *values):
+        members = self._data.setdefault(name, set())
+        added = sum(1 for v in values if str(v) not in members)
+        members.update(str(v) for v in values)
+        return added
+
+    def sismember(self, name, value):
+        return str(value) in self._data.get(name, set())
+
+    def srem(self, name, *values):
+        members = self._data.get(name, set())
+        removed = sum(1 for v in values if str(v) in members)
+        members.difference_update(str(v) for v in values)
+        if not members:
+            self._data.pop(name, None)
+        return removed
+
+    def scard(self, name):
+        return len(self._data.get(name, set()))
+
+    def smembers(self, name):
+        return set(self._data.get(name, set()))
+
+    def spop(self, name, count=None):
+        members = self._data.get(name, set())
+        popped = [members.pop() for _ in range(min(count or 1, len(members)))]
+        if not members:
+            self._data.pop(name, None)
+        if count is None:
+            return popped[0] if popped else None
+        return popped
+
+    def zadd(self, name, mapping):
+        scores = self._data.setdefault(name, {})
+        added = sum(1 for k in mapping if k not in scores)
+        scores.update({str(k): float(v) for k, v in mapping.items()})
+        return added
+
+    def zrangebyscore(self, name, min, max, start=None, num=None):
+        scores = self._data.get(name, {})
+        members = sorted((s, k) for k, s in scores.items() if float(min) <= s <= float(max))
+        members = [k for _, k in members]
+        if start is not None:
+            members = members[start:start + num]
+        return members
+
+    def zrem(self, name, *values):
+        scores = self._data.get(name, {})
+        return sum(1 for v in values if scores.pop(str(v), None) is not None)
+
+    def rpush(self, name, *values):
+        items = self._data.setdefault(name, [])
+        items.extend(str(v) for v in values)
+        return len(items)
+
+    def lrange(self, name, start, end):
+        items = self._data.get(name, [])
+        return items[start:] if end == -1 else items[start:end + 1]
+
+    def ltrim(self, name, start, end):
+        items = self._data.get(name, [])
+        self._data[name] = items[start:] if end == -1 else items[start:end + 1]
+        return True
+
+    def exists(self, *names):
+        return sum(1 for name in names if name in self._data)
+
+    def expire(self, name, seconds):
+        return name in self._data
+
+    def delete(self, *names):
+        return sum(1 for name in names if self._data.pop(name, None) is not None)
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+
+class Pipeline:
+    """Buffers commands and runs them on execute(), like a redis-py pipeline."""
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def buffer(*args, **kwargs):
+            self._calls.append((method, args, kwargs))
+            return self
+        return buffer
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [method(*args, **kwargs) for method, args, kwargs in calls]
+
+
+Redis = StrictRedis
+
+
+def reset():
+    _data.clear()
@@ -0,0 +1,39 @@
+"""Async flavour of the redis stand-in; it shares the keyspace with the sync client."""
+from . import StrictRedis as _SyncRedis
+
+
+class StrictRedis:
+    def __init__(self, host=None, port=None, decode_responses=False, **kwargs):
+        self._sync = _SyncRedis(host, port, decode_responses, **kwargs)
+
+    def __getattr__(self, name):
+        method = getattr(self._sync, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self._sync.pipeline(transaction))
+
+    async def close(self):
+        pass
+
+
+class Pipeline:
+    def __init__(self, pipe):
+        self._pipe = pipe
+
+    def __getattr__(self, name):
+        buffer = getattr(self._pipe, name)
+
+        def call(*args, **kwargs):
+            buffer(*args, **kwargs)
+            return self
+        return call
+
+    async def execute(self):
+        return self._pipe.execute()
+
+
+Redis = StrictRedis
@@ -0,0 +1,33 @@
+"""
+Stand-in for spleeter.separator.Separator.
+
+Instead of running the model it decodes the input once with ffmpeg and writes
+one WAV per stem, so the downstream stages see the same files and the same
+amount of scratch data as a real 5-stem separation.
+"""
+import os
+import shutil
+import subprocess
+
+STEMS = {
+    "spleeter:2stems": ["vocals", "accompaniment"],
+    "spleeter:4stems": ["vocals", "drums", "bass", "other"],
+    "spleeter:5stems": ["vocals", "drums", "bass", "piano", "other"],
+}
+
+
+class Separator:
+    def __init__(self, params_descriptor, multiprocess=True, **kwargs):
+        self.stems = STEMS[params_descriptor]
+
+    def separate_to_file(self, audio_descriptor, destination, offset=0, duration=600.0,
+                         filename_format="{filename}/{instrument}.{codec}", **kwargs):
+        base = os.path.splitext(os.path.basename(audio_descriptor))[0]
+        folder = os.path.join(destination, os.path.dirname(filename_format.format(filename=base, instrument="", codec="wav")))
+        os.makedirs(folder, exist_ok=True)
+        first = os.path.join(folder, f"{self.stems[0]}.wav")
+        cmd = ["ffmpeg", "-y", "-ss", str(offset), "-t", str(duration), "-i", audio_descriptor,
+               "-ac", "2", "-ar", "44100", "-acodec", "pcm_s16le", first]
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        for stem in self.stems[1:]:
+            shutil.copyfile(first, os.path.join(folder, f"{stem}.wav"))
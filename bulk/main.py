@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+Bulk library mode: run an existing library through the pipeline without
+RabbitMQ or the watcher.
+
+Each stage runs in its own pool of worker processes, loaded from the stage's
+main.py and kept warm (the splitter loads the Spleeter model once per worker),
+and tracks move between the pools on in-memory queues:
+
+    scan -> split -> convert -> combine -> tag
+
+Progress is checkpointed per track in a JSON-lines manifest, so an interrupted
+run resumes where it stopped. Tracks whose instrumental already exists in the
+music folder are skipped. Redis must be reachable: track metadata is stored
+there the same way the watcher stores it.
+
+    python bulk/main.py /library --split-workers 2 --convert-workers 8
+"""
+import argparse
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+logger = logging.getLogger("bulk")
+
+BULK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BULK_DIR)
+# The stages import the kip helper package, which their images ship next to main.py.
+sys.path.insert(0, os.path.join(REPO_ROOT, "shared"))
+
+from kip import profiling  # noqa: E402
+from kip.artifacts import finalize_job, register_artifacts  # noqa: E402
+from kip.naming import instrumental_filename  # noqa: E402
+
+MUSIC_DIR = "/music"
+SPLITTER_OUTPUT_DIR = "/splitter_output"
+MANIFEST_FILE = os.getenv("BULK_MANIFEST_FILE", "/music/.bulk_manifest.jsonl")
+STAGES = ["splitter", "converter", "combiner", "metadata"]
+
+redis_client = None  # set in each stage worker
+
+def load_stage(name):
+    """Import <name>/main.py as its own module, the way its container would run it."""
+    spec = importlib.util.spec_from_file_location(f"kip_{name}", os.path.join(REPO_ROOT, name, "main.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def scratch_dir(item):
+    return os.path.join(SPLITTER_OUTPUT_DIR, "bulk", item["job_id"])
+
+def expected_output(item):
+    """Where the combiner will write this track's instrumental."""
+    return os.path.join(MUSIC_DIR, instrumental_filename(item["metadata"], item["original_filename"]))
+
+def split(module, item):
+    # Registered before separating, so the GC reclaims the scratch of a worker that dies mid-track.
+    register_artifacts(redis_client, item["job_id"], scratch_dir(item))
+    payload = module.separate_track(item["path"], item["metadata_key"], job=item,
+                                    output_dir=scratch_dir(item), copy_original=False)
+    if not payload or not payload["stems"]:
+        raise RuntimeError("stem separation produced no stems")
+    item["source_folder"] = payload["source_folder"]
+    item["stems"] = payload["stems"]
+    return item
+
+def convert(module, item):
+    output_folder = os.path.join(item["source_folder"], "converted")
+    os.makedirs(output_folder, exist_ok=True)
+    converted = []
+    for stem in item["stems"]:
+        output_file = os.path.join(output_folder, os.path.splitext(stem)[0] + ".mp3")
+        if not module.convert_wav_to_mp3(os.path.join(item["source_folder"], stem), output_file, item):
+            raise RuntimeError(f"could not convert {stem}")
+        converted.append(os.path.basename(output_file))
+    item["source_folder"] = output_folder
+    item["stems"] = converted
+    return item
+
+def combine(module, item):
+    item["final_file"], _ = module.combine_stems(item)
+    return item
+
+def tag(module, item):
+    if item["metadata"]:
+        module.apply_metadata(item["final_file"], item["metadata"])
+    shutil.rmtree(scratch_dir(item), ignore_errors=True)
+    finalize_job(redis_client, item["job_id"])
+    return item
+
+HANDLERS = {"splitter": split, "converter": convert, "combiner": combine, "metadata": tag}
+
+def stage_worker(stage, settings, inbox, outbox, results):
+    """Worker process: load one stage once, then handle tracks from inbox until a None arrives."""
+    global MUSIC_DIR, SPLITTER_OUTPUT_DIR, redis_client
+    MUSIC_DIR, SPLITTER_OUTPUT_DIR = settings["music"], settings["scratch"]
+    redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
+    module = load_stage(stage)
+    profiling.PROFILE_DIR = settings["profile_dir"]
+    if stage == "combiner":
+        module.MUSIC_DIR = MUSIC_DIR
+    handler = HANDLERS[stage]
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        try:
+            item = handler(module, item)
+        except Exception as e:
+            logger.error("%s failed for %s: %s", stage, item["path"], e)
+            shutil.rmtree(scratch_dir(item), ignore_errors=True)
+            finalize_job(redis_client, item["job_id"])
+            results.put({"path": item["path"], "size": item["size"], "mtime": item["mtime"],
+                         "status": "failed", "error": f"{stage}: {e}"})
+            continue
+        if outbox is not None:
+            outbox.put(item)
+        else:
+            results.put({"path": item["path"], "size": item["size"], "mtime": item["mtime"],
+                         "status": "done", "final_file": item["final_file"]})
+
+class BulkManifest:
+    """Per-track outcome of earlier runs, as an append-only JSON-lines journal keyed by path."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # torn write from a crash
+                    self.entries[record["path"]] = record
+        except FileNotFoundError:
+            pass
+
+    def is_done(self, path, size, mtime):
+        record = self.entries.get(path)
+        return bool(record) and record["status"] in ("done", "exists", "duplicate") and (record["size"], record["mtime"]) == (size, mtime)
+
+    def record(self, record):
+        self.entries[record["path"]] = record
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+
+def prepare(watcher, path, size, mtime, profile):
+    """Hash and read the tags of one track, storing them in Redis the way the watcher does."""
+    try:
+        metadata_key = watcher.compute_file_hash(path)
+        metadata = watcher.extract_metadata(path)
+        watcher.store_metadata(metadata_key, metadata)
+    except Exception as e:
+        return {"path": path, "size": size, "mtime": mtime, "status": "failed", "error": f"prepare: {e}"}
+    return {
+        "path": path,
+        "size": size,
+        "mtime": mtime,
+        "metadata_key": metadata_key,
+        # Not the bare hash: finalising this id must never release the artifacts
+        # of the same track going through the queued pipeline.
+        "job_id": f"bulk-{metadata_key}",
+        "original_filename": os.path.basename(path),
+        "metadata": metadata,
+        "profile": profile
+    }
+
+def run(args):
+    global MUSIC_DIR, SPLITTER_OUTPUT_DIR
+    MUSIC_DIR, SPLITTER_OUTPUT_DIR = args.music, args.scratch
+    # The watcher module provides the scan, hashing and tag helpers; importing
+    # it does not start watching anything.
+    watcher = load_stage("watcher")
+    manifest = BulkManifest(args.manifest)
+
+    started = time.monotonic()
+    present = watcher.scan_tree(args.library)
+    todo = sorted(path for path, (size, mtime) in present.items() if not manifest.is_done(path, size, mtime))
+    logger.info("Library %s: %d tracks, %d already done in an earlier run.",
+                args.library, len(present), len(present) - len(todo))
+    # Scratch left by an interrupted run belongs to tracks that are redone.
+    shutil.rmtree(os.path.join(SPLITTER_OUTPUT_DIR, "bulk"), ignore_errors=True)
+
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    # Bounded queues keep at most a few tracks' stems on disk per worker.
+    inboxes = {stage: ctx.Queue(maxsize=2 * workers) for stage, workers in zip(STAGES, args.workers)}
+    settings = {"music": MUSIC_DIR, "scratch": SPLITTER_OUTPUT_DIR, "profile_dir": args.profile_dir}
+    processes = []
+    for index, (stage, workers) in enumerate(zip(STAGES, args.workers)):
+        outbox = inboxes[STAGES[index + 1]] if index + 1 < len(STAGES) else None
+        for _ in range(workers):
+            process = ctx.Process(target=stage_worker, args=(stage, settings, inboxes[stage], outbox, results),
+                                  name=f"bulk-{stage}", daemon=True)
+            process.start()
+            processes.append((stage, process))
+
+    submitted = 0
+    feeding_done = threading.Event()
+
+    def feed():
+        nonlocal submitted
+        seen = set()
+        with ThreadPoolExecutor(max_workers=args.scan_workers) as pool:
+            items = pool.map(lambda path: prepare(watcher, path, *present[path], args.profile), todo)
+            for item in items:
+                submitted += 1
+                record = {"path": item["path"], "size": item["size"], "mtime": item["mtime"]}
+                if item.get("status") == "failed":
+                    results.put(item)
+                elif item["metadata_key"] in seen:
+                    # Byte-identical copy of a track already in this run.
+                    results.put(dict(record, status="duplicate"))
+                elif os.path.exists(expected_output(item)):
+                    results.put(dict(record, status="exists", final_file=expected_output(item)))
+                else:
+                    seen.add(item["metadata_key"])
+                    inboxes["splitter"].put(item)
+        feeding_done.set()
+
+    feeder = threading.Thread(target=feed, name="bulk-feeder", daemon=True)
+    feeder.start()
+
+    finished = {"done": 0, "exists": 0, "duplicate": 0, "failed": 0}
+    while not (feeding_done.is_set() and sum(finished.values()) == submitted):
+        try:
+            record = results.get(timeout=1)
+        except queue.Empty:
+            crashed = [stage for stage, process in processes if process.exitcode not in (None, 0)]
+            if crashed:
+                logger.error("A %s worker exited unexpectedly; stopping. Rerun to resume.", crashed[0])
+                return 1
+            continue
+        manifest.record(record)
+        finished[record["status"]] += 1
+        total = sum(finished.values())
+        if record["status"] == "failed":
+            logger.warning("Failed: %s (%s)", record["path"], record["error"])
+        if total % args.report_every == 0:
+            elapsed = time.monotonic() - started
+            logger.info("Progress: %d/%d tracks (%.0f tracks/hour).", total, len(todo), 3600 * total / elapsed)
+
+    for stage, workers in zip(STAGES, args.workers):
+        for _ in range(workers):
+            inboxes[stage].put(None)
+    for _, process in processes:
+        process.join()
+
+    elapsed = time.monotonic() - started
+    logger.info("Bulk run finished in %.0fs: %d rendered, %d already in %s, %d duplicates, %d failed.",
+                elapsed, finished["done"], finished["exists"], MUSIC_DIR, finished["duplicate"], finished["failed"])
+    return 1 if finished["failed"] else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("library", help="folder to scan for .mp3 files (read in place, never modified)")
+    parser.add_argument("--music", default=MUSIC_DIR, help="where instrumentals are written (default: %(default)s)")
+    parser.add_argument("--scratch", default=SPLITTER_OUTPUT_DIR, help="scratch folder for stems (default: %(default)s)")
+    parser.add_argument("--manifest", default=MANIFEST_FILE, help="resumable progress manifest (default: %(default)s)")
+    parser.add_argument("--split-workers", type=int, default=1, help="splitter processes, each with its own model")
+    parser.add_argument("--convert-workers", type=int, default=os.cpu_count() or 2, help="converter processes")
+    parser.add_argument("--combine-workers", type=int, default=2, help="combiner processes")
+    parser.add_argument("--tag-workers", type=int, default=1, help="metadata processes")
+    parser.add_argument("--scan-workers", type=int, default=8, help="threads hashing and reading tags")
+    parser.add_argument("--profile", action="store_true", help="profile every track (artifacts go to --profile-dir)")
+    parser.add_argument("--profile-dir", default="/profiles", help="profiling artifacts (default: %(default)s)")
+    parser.add_argument("--report-every", type=int, default=50, help="log progress every N tracks")
+    args = parser.parse_args()
+    args.workers = [args.split_workers, args.convert_workers, args.combine_workers, args.tag_workers]
+    sys.exit(run(args))
+
+if __name__ == "__main__":
+    main()
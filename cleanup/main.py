@@ -2,8 +2,19 @@ import os
 import shutil
 import json
 import time
+import signal
+import asyncio
 import logging
-import pika
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import aio_pika
+import redis.asyncio as redis
+from prometheus_client import Counter, start_http_server
+from kip.tracing import AsyncTracer
+from kip.profiling import start_profile, stop_profile
+from kip.artifacts import (ARTIFACT_JOBS_KEY, FINALIZED_KEY, WAITING_KEY, artifact_refs_key, artifacts_key,
+                           children_key, finalize_job_async, parent_key, queue_artifacts)
+from kip.scratch import SCRATCH_RESERVED_KEY, reservation_ids
 
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
@@ -12,26 +23,64 @@ logger = logging.getLogger(__name__)
 RABBITMQ_HOST = "rabbitmq"
 CLEANUP_QUEUE = "cleanup_jobs"
 
-def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=10, delay=3):
+# Deletes are I/O bound, so one container keeps many jobs in flight: up to
+# CONSUMER_PREFETCH unacked messages, with file work on FILE_WORKERS threads.
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "100"))
+FILE_WORKERS = int(os.getenv("FILE_WORKERS", "8"))
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "60"))  # seconds to finish in-flight jobs on shutdown
+
+# Artifact GC: stages register every intermediate file under its job_id
+# (artifacts:<job_id>, with a reverse artifact_refs:<path> set). A cleanup job
+# only marks its job finalised; a background pass then deletes each artifact
+# whose last reference is gone. Jobs that never finalise are reclaimed once they
+# have been idle for ARTIFACT_TTL seconds, counted from when the splitter picked
+# them up: jobs still waiting for it (WAITING_KEY) are never expired.
+ARTIFACT_TTL = int(os.getenv("ARTIFACT_TTL", str(24 * 3600)))
+GC_INTERVAL = float(os.getenv("GC_INTERVAL", "30"))
+GC_BATCH = int(os.getenv("GC_BATCH", "100"))  # jobs released per pass
+GC_MAX_MB_PER_SECOND = float(os.getenv("GC_MAX_MB_PER_SECOND", "200"))  # 0 disables the delete rate limit
+
+redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
+file_pool = ThreadPoolExecutor(max_workers=FILE_WORKERS)
+
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "cleanup"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9007"))
+
+GC_RECLAIMED_BYTES = Counter("kip_gc_reclaimed_bytes_total", "Bytes reclaimed by the artifact GC")
+GC_RECLAIMED_ARTIFACTS = Counter("kip_gc_reclaimed_artifacts_total", "Artifacts deleted by the artifact GC")
+
+tracer = AsyncTracer(STAGE, redis_client)
+
+async def connect_to_rabbitmq_with_retries(host, max_attempts=10, delay=3):
     for attempt in range(1, max_attempts + 1):
         try:
             logger.info("Attempting connection to RabbitMQ (%d/%d)...", attempt, max_attempts)
-            parameters = pika.ConnectionParameters(
-                host=host,
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300
-            )
-            connection = pika.BlockingConnection(parameters)
+            connection = await aio_pika.connect_robust(host=host, login='admin', password='admin', heartbeat=600)
             logger.info("Connected to RabbitMQ.")
             return connection
         except Exception as e:
             logger.warning("RabbitMQ connection failed on attempt %d: %s", attempt, e)
-            time.sleep(delay)
+            await asyncio.sleep(delay)
     raise ConnectionError("Could not connect to RabbitMQ.")
 
+def path_size(path):
+    """Bytes on disk under path (a file or a whole folder)."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
 def cleanup_path(path):
+    """Delete a file or folder; returns the number of bytes reclaimed."""
     if os.path.exists(path):
+        size = path_size(path)
         try:
             if os.path.isfile(path):
                 os.remove(path)
@@ -39,45 +88,166 @@ def cleanup_path(path):
             elif os.path.isdir(path):
                 shutil.rmtree(path)
                 logger.info("Removed folder: %s", path)
+            return size
         except Exception as e:
             logger.error("Error removing path %s: %s", path, e)
     else:
         logger.info("Path %s not found; skipping cleanup.", path)
+    return 0
+
+async def register_artifacts(job_id, paths):
+    pipe = redis_client.pipeline(transaction=False)
+    queue_artifacts(pipe, job_id, paths)
+    await pipe.execute()
+
+async def release_job(job_id):
+    """
+    Drop job_id's references to its artifacts and delete the ones no other job
+    still refers to. Returns (artifacts deleted, bytes reclaimed).
+    """
+    paths = await redis_client.smembers(artifacts_key(job_id))
+    loop = asyncio.get_running_loop()
+    deleted = reclaimed = 0
+    for path in sorted(paths):
+        refs_key = artifact_refs_key(path)
+        await redis_client.srem(refs_key, job_id)
+        if await redis_client.scard(refs_key):
+            continue
+        size = await loop.run_in_executor(file_pool, cleanup_path, path)
+        deleted += 1
+        reclaimed += size
+        # Rate-limit deletes so a large GC pass does not starve the pipeline's disk I/O.
+        if GC_MAX_MB_PER_SECOND > 0 and size:
+            await asyncio.sleep(size / (GC_MAX_MB_PER_SECOND * 1024 * 1024))
+    await redis_client.delete(artifacts_key(job_id), children_key(job_id), parent_key(job_id))
+    await redis_client.zrem(ARTIFACT_JOBS_KEY, job_id)
+    await redis_client.srem(WAITING_KEY, job_id)
+    # A job that never got through the splitter must not hold scratch reservations forever.
+    await redis_client.hdel(SCRATCH_RESERVED_KEY, *reservation_ids(job_id))
+    GC_RECLAIMED_ARTIFACTS.inc(deleted)
+    GC_RECLAIMED_BYTES.inc(reclaimed)
+    return deleted, reclaimed
+
+async def expired_jobs():
+    """
+    Up to GC_BATCH jobs idle for longer than ARTIFACT_TTL. Jobs still waiting
+    for the splitter (pending admission, queued, or a full render behind its
+    preview) are skipped and their idle time restarted, so they do not keep
+    filling the batch.
+    """
+    expired = await redis_client.zrangebyscore(ARTIFACT_JOBS_KEY, 0, time.time() - ARTIFACT_TTL, start=0, num=GC_BATCH)
+    if not expired:
+        return []
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in expired:
+        pipe.sismember(WAITING_KEY, job_id)
+    waiting = {job_id for job_id, is_waiting in zip(expired, await pipe.execute()) if is_waiting}
+    if waiting:
+        await redis_client.zadd(ARTIFACT_JOBS_KEY, {job_id: time.time() for job_id in waiting})
+    return [job_id for job_id in expired if job_id not in waiting]
+
+async def gc_pass():
+    """Release finalised jobs, then jobs idle for longer than ARTIFACT_TTL."""
+    job_ids = set(await redis_client.spop(FINALIZED_KEY, GC_BATCH) or [])
+    expired = await expired_jobs()
+    job_ids.update(expired)
+    deleted = reclaimed = 0
+    for job_id in job_ids:
+        try:
+            job_deleted, job_reclaimed = await release_job(job_id)
+            deleted += job_deleted
+            reclaimed += job_reclaimed
+        except Exception as e:
+            logger.error("Artifact GC failed for job %s: %s", job_id, e)
+    if job_ids:
+        logger.info("Artifact GC released %d jobs (%d expired): %d artifacts, %.1f MB reclaimed.",
+                    len(job_ids), len(expired), deleted, reclaimed / (1024 * 1024))
+    return reclaimed
+
+async def collect_garbage():
+    while True:
+        try:
+            await gc_pass()
+        except Exception as e:
+            logger.error("Artifact GC pass failed: %s", e)
+        await asyncio.sleep(GC_INTERVAL)
 
-def callback(ch, method, properties, body):
+async def process_job(job, channel=None):
+    span = tracer.start_span(job)
+    profiler = start_profile(job)
     try:
-        job = json.loads(body.decode())
+        job_id = job.get("job_id")
         cleanup_paths = job.get("cleanup_paths", [])
-        if not cleanup_paths:
-            logger.info("No cleanup paths provided in job; nothing to do.")
-            ch.basic_ack(delivery_tag=method.delivery_tag)
+        if cleanup_paths:
+            # Jobs published before the registry existed list their paths here.
+            job_id = job_id or f"legacy:{uuid.uuid4().hex}"
+            await register_artifacts(job_id, cleanup_paths)
+        if not job_id:
+            logger.info("Cleanup job has no job_id or cleanup paths; nothing to do.")
+            await tracer.finish_span(span, path=job.get("final_file"))
             return
-        for path in cleanup_paths:
-            cleanup_path(path)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        await finalize_job_async(redis_client, job_id)
+        logger.info("Marked job %s finalised; its artifacts will be reclaimed by the GC.", job_id)
+        await tracer.finish_span(span, path=job.get("final_file"), job_id=job_id)
+    except Exception as e:
+        await tracer.finish_span(span, error=str(e))
+        raise
+    finally:
+        stop_profile(profiler, job, STAGE)
+
+async def handle_message(message, channel):
+    """Process one delivery and ack or nack it on its own, independently of the other in-flight jobs."""
+    try:
+        job = json.loads(message.body.decode())
+        await process_job(job, channel)
+        await message.ack()
     except Exception as e:
         logger.error("Error processing cleanup job: %s", e)
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        await message.nack(requeue=False)
 
-def run_cleanup_service():
-    credentials = pika.PlainCredentials('admin', 'admin')
-    while True:
-        try:
-            connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
-            channel = connection.channel()
-            channel.queue_declare(queue=CLEANUP_QUEUE, durable=True)
-            channel.basic_qos(prefetch_count=1)
-            channel.basic_consume(queue=CLEANUP_QUEUE, on_message_callback=callback)
-            logger.info("Cleanup service started. Listening for cleanup jobs...")
-            channel.start_consuming()
-        except Exception as e:
-            logger.error("Cleanup service error: %s. Reconnecting in 5 seconds...", e)
-            time.sleep(5)
-        finally:
-            try:
-                connection.close()
-            except Exception:
-                pass
+async def run_cleanup_service():
+    start_http_server(METRICS_PORT)
+    connection = await connect_to_rabbitmq_with_retries(RABBITMQ_HOST)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=CONSUMER_PREFETCH)
+    queue = await channel.declare_queue(CLEANUP_QUEUE, durable=True)
+
+    in_flight = set()
+
+    async def on_message(message):
+        task = asyncio.ensure_future(handle_message(message, channel))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    gc_task = asyncio.ensure_future(collect_garbage())
+    consumer_tag = await queue.consume(on_message)
+    logger.info("Cleanup service started (prefetch=%d). Listening for cleanup jobs...", CONSUMER_PREFETCH)
+    await stop.wait()
+
+    # Graceful drain: stop deliveries, let in-flight jobs finish and ack, then
+    # close. Jobs still running after DRAIN_TIMEOUT are cancelled unacked, so
+    # RabbitMQ redelivers them.
+    logger.info("Shutting down; draining %d in-flight jobs...", len(in_flight))
+    await queue.cancel(consumer_tag)
+    if in_flight:
+        _, still_running = await asyncio.wait(in_flight, timeout=DRAIN_TIMEOUT)
+        # Cancel what did not finish and wait for the cancellations to land, so no
+        # task still touches the channel, Redis or the file pool while they close.
+        if still_running:
+            logger.warning("Cancelling %d jobs still running after %ds.", len(still_running), DRAIN_TIMEOUT)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+    gc_task.cancel()
+    await asyncio.gather(gc_task, return_exceptions=True)
+    await connection.close()
+    await redis_client.close()
+    file_pool.shutdown(wait=True)
 
 if __name__ == "__main__":
-    run_cleanup_service()
+    asyncio.run(run_cleanup_service())
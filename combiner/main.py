@@ -6,6 +6,10 @@ import subprocess
 import logging
 import redis
 import time
+from prometheus_client import Counter, Histogram, start_http_server
+from kip.tracing import Tracer
+from kip.profiling import profiling_enabled, profile_artifact_path, start_profile, stop_profile
+from kip.naming import instrumental_filename
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
@@ -19,6 +23,22 @@ REDIS_HOST = os.getenv("REDIS_HOST", "redis")
 REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
 redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
 
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "combiner"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9005"))
+
+BYTES_READ = Counter("kip_bytes_read_total", "Bytes of audio read", ["stage"])
+BYTES_WRITTEN = Counter("kip_bytes_written_total", "Bytes of audio written", ["stage"])
+TOOL_TIME = Histogram("kip_tool_seconds", "Time spent in ffmpeg or the separation model", ["stage", "tool"])
+
+tracer = Tracer(STAGE, redis_client)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
 def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=10, delay=3):
     for attempt in range(1, max_attempts+1):
         try:
@@ -37,53 +57,70 @@ def get_stored_metadata(metadata_key):
     metadata = redis_client.hgetall(key)
     return metadata
 
-def generate_canonical_filename(metadata):
+def save_ffmpeg_benchmark(job, name, stderr):
+    """Keep ffmpeg's -benchmark report (with the rest of its log) as a profile artifact."""
+    try:
+        path = profile_artifact_path(job, name)
+        with open(path, "wb") as f:
+            f.write(stderr)
+    except Exception as e:
+        logger.warning("Failed to write ffmpeg benchmark output: %s", e)
+
+def place_preview(preview_file, final_output):
     """
-    Build the canonical filename using the song's metadata.
-    Returns a string in the format: "%title% - %artist% - (Instrumental).mp3"
+    Move a preview to the track's final name unless a file is already there:
+    the full render may have overtaken the preview, and must never be
+    overwritten by it. The hard link makes the check and the move one step.
     """
-    title = metadata.get("title", "").strip() if metadata.get("title") else ""
-    artist = metadata.get("artist", "").strip() if metadata.get("artist") else ""
-    if title and artist:
-        return f"{title} - {artist} - (Instrumental).mp3"
-    return None
+    try:
+        os.link(preview_file, final_output)
+    except FileExistsError:
+        logger.info("%s is already in place; dropping the preview.", final_output)
+    except OSError:
+        # No hard links on this filesystem: fall back to check-then-rename.
+        if not os.path.exists(final_output):
+            os.replace(preview_file, final_output)
+            return
+    os.remove(preview_file)
 
 def combine_stems(job):
     source_folder = job.get("source_folder")
     stems = job.get("stems", [])
     original_filename = job.get("original_filename", "output.mp3")
-    if job.get("type") == "album":
-        cleanup_target = job.get("album_folder")
-    else:
-        cleanup_target = job.get("original_file")
     metadata_key = job.get("metadata_key")
     metadata = get_stored_metadata(metadata_key)
-    canonical_name = generate_canonical_filename(metadata)
-    if not canonical_name:
-        base, _ = os.path.splitext(original_filename)
-        canonical_name = f"{base}_combined.mp3"
+    canonical_name = instrumental_filename(metadata, original_filename)
     final_output = os.path.join(MUSIC_DIR, canonical_name)
+    render = job.get("render")
+    if render:
+        # Previews and full renders are mixed under a hidden name first: a
+        # preview is then moved into place here, a full render only once the
+        # metadata stage has tagged it, so the library never shows a partial file.
+        output_file = os.path.join(MUSIC_DIR, f".{canonical_name}.{render}.mp3")
+    else:
+        output_file = final_output
     input_files = [os.path.join(source_folder, stem) for stem in stems]
     num_inputs = len(input_files)
-    cmd = ["ffmpeg", "-y"]
+    benchmark = profiling_enabled(job)
+    cmd = ["ffmpeg", "-y"] + (["-benchmark"] if benchmark else [])
     for file in input_files:
         cmd.extend(["-i", file])
     filter_complex = f"amix=inputs={num_inputs}:duration=longest"
-    cmd.extend(["-filter_complex", filter_complex, final_output])
+    cmd.extend(["-filter_complex", filter_complex, output_file])
     logger.info("🔄 Combining stems with command: %s", " ".join(cmd))
-    subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    logger.info("✅ Combined instrumental created at: %s", final_output)
-    cleanup_paths = []
-    duplicate_path = os.path.join("/pipeline", os.path.basename(cleanup_target))
-    if os.path.exists(duplicate_path):
-        cleanup_paths.append(duplicate_path)
-    cleanup_paths.append(cleanup_target)
-    base_folder = os.path.splitext(os.path.basename(cleanup_target))[0]
-    splitter_folder = os.path.join("/splitter_output", base_folder)
-    cleanup_paths.append(splitter_folder)
-    converted_folder = os.path.join(splitter_folder, "converted")
-    cleanup_paths.append(converted_folder)
-    return final_output, canonical_name, cleanup_paths
+    with TOOL_TIME.labels(STAGE, "ffmpeg").time():
+        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if benchmark:
+        save_ffmpeg_benchmark(job, "combiner.ffmpeg.txt", result.stderr)
+    BYTES_READ.labels(STAGE).inc(sum(file_size(f) for f in input_files))
+    BYTES_WRITTEN.labels(STAGE).inc(file_size(output_file))
+    if render == "preview":
+        place_preview(output_file, final_output)
+        output_file = final_output
+    logger.info("✅ Combined %s created at: %s", "preview" if render == "preview" else "instrumental", output_file)
+    # Intermediate files are reclaimed through the artifact registry once the
+    # cleanup service sees this job finalised.
+    return output_file, canonical_name
 
 def send_metadata_job(job_payload, credentials):
     try:
@@ -103,7 +140,7 @@ def send_metadata_job(job_payload, credentials):
     except Exception as e:
         logger.error("❌ Failed to send metadata job: %s", e)
 
-def send_cleanup_job(original_file, final_file, converted_folder, credentials):
+def send_cleanup_job(original_file, final_file, converted_folder, credentials, trace=None, job_id=None, profile=False):
     try:
         connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
         channel = connection.channel()
@@ -112,7 +149,10 @@ def send_cleanup_job(original_file, final_file, converted_folder, credentials):
         payload = {
             "original_file": original_file,
             "final_file": final_file,
-            "converted_folder": converted_folder
+            "converted_folder": converted_folder,
+            "job_id": job_id,
+            "profile": profile,
+            "trace": trace
         }
         body = json.dumps(payload)
         channel.basic_publish(
@@ -128,10 +168,15 @@ def send_cleanup_job(original_file, final_file, converted_folder, credentials):
 
 def callback(ch, method, properties, body):
     credentials = pika.PlainCredentials('admin', 'admin')
+    span = None
+    profiler = None
+    job = {}
     try:
         job = json.loads(body.decode())
+        span = tracer.start_span(job)
+        profiler = start_profile(job)
         logger.info("📬 Received combiner job: %s", job)
-        final_file, canonical_name, cleanup_paths = combine_stems(job)
+        final_file, canonical_name = combine_stems(job)
         ch.basic_ack(delivery_tag=method.delivery_tag)
         metadata_job = {
             "original_file": job.get("album_folder") or job.get("original_file"),
@@ -140,31 +185,34 @@ def callback(ch, method, properties, body):
             "source_folder": job.get("source_folder"),
             "metadata_key": job.get("metadata_key"),
             "canonical_name": canonical_name,
-            "cleanup_paths": cleanup_paths,
-            "early": False
+            "early": False,
+            "job_id": job.get("job_id"),
+            "profile": job.get("profile", False),
+            "trace": tracer.trace_context(span)
         }
+        if job.get("render"):
+            metadata_job["render"] = job["render"]
+        if job.get("render") == "full":
+            metadata_job["replaces"] = os.path.join(MUSIC_DIR, canonical_name)
         send_metadata_job(metadata_job, credentials)
 
-        metadata_job = {
-            "original_file": job.get("album_folder") or job.get("original_file"),
-            "final_file": final_file,
-            "original_filename": job.get("original_filename"),
-            "source_folder": job.get("source_folder"),
-            "metadata_key": job.get("metadata_key"),
-            "canonical_name": canonical_name,
-            "cleanup_paths": cleanup_paths,
-            "early": False
-        }
-        send_metadata_job(metadata_job, credentials)
-
-        primary_cleanup_path = cleanup_paths[0] if cleanup_paths else (job.get("album_folder") or job.get("original_file"))
-        converted_folder = cleanup_paths[-1] if cleanup_paths else None
-        send_cleanup_job(primary_cleanup_path, final_file, converted_folder, credentials)
+        # The stems are no longer needed once the mix exists; this finalises the
+        # job so the cleanup GC can reclaim its artifacts straight away. A
+        # preview's original is still needed for the full render.
+        if job.get("render") != "preview":
+            send_cleanup_job(job.get("album_folder") or job.get("original_file"), final_file, job.get("source_folder"),
+                             credentials, tracer.trace_context(span), job.get("job_id"), job.get("profile", False))
+        tracer.finish_span(span, path=final_file)
     except Exception as e:
         logger.error("❌ Error processing combiner job: %s", e)
+        if span:
+            tracer.finish_span(span, error=str(e))
         ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    finally:
+        stop_profile(profiler, job, STAGE)
 
 def run():
+    start_http_server(METRICS_PORT)
     credentials = pika.PlainCredentials('admin', 'admin')
     connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
     channel = connection.channel()
@@ -2,8 +2,13 @@ import os
 import time
 import json
 import pika
+import redis
 import subprocess
 import logging
+from prometheus_client import Counter, Histogram, start_http_server
+from kip.tracing import Tracer
+from kip.profiling import profiling_enabled, profile_artifact_path, start_profile, stop_profile
+from kip.artifacts import register_artifacts
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
@@ -12,6 +17,24 @@ RABBITMQ_HOST = "rabbitmq"
 CONVERTER_QUEUE = "converter_jobs"
 COMBINER_QUEUE = "combiner_jobs"
 
+redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
+
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "converter"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9004"))
+
+BYTES_READ = Counter("kip_bytes_read_total", "Bytes of audio read", ["stage"])
+BYTES_WRITTEN = Counter("kip_bytes_written_total", "Bytes of audio written", ["stage"])
+TOOL_TIME = Histogram("kip_tool_seconds", "Time spent in ffmpeg or the separation model", ["stage", "tool"])
+
+tracer = Tracer(STAGE, redis_client)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
 def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=10, delay=3):
     for attempt in range(1, max_attempts + 1):
         try:
@@ -28,11 +51,26 @@ def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=10, delay=3
             time.sleep(delay)
     raise ConnectionError("Could not connect to RabbitMQ after multiple attempts.")
 
-def convert_wav_to_mp3(source_file, output_file):
+def save_ffmpeg_benchmark(job, name, stderr):
+    """Keep ffmpeg's -benchmark report (with the rest of its log) as a profile artifact."""
     try:
-        cmd = ["ffmpeg", "-y", "-i", source_file, output_file]
+        path = profile_artifact_path(job, name)
+        with open(path, "wb") as f:
+            f.write(stderr)
+    except Exception as e:
+        logger.warning("Failed to write ffmpeg benchmark output: %s", e)
+
+def convert_wav_to_mp3(source_file, output_file, job=None):
+    benchmark = job is not None and profiling_enabled(job)
+    try:
+        cmd = ["ffmpeg", "-y"] + (["-benchmark"] if benchmark else []) + ["-i", source_file, output_file]
         logger.info("Converting: %s -> %s", source_file, output_file)
-        result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with TOOL_TIME.labels(STAGE, "ffmpeg").time():
+            result = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        BYTES_READ.labels(STAGE).inc(file_size(source_file))
+        BYTES_WRITTEN.labels(STAGE).inc(file_size(output_file))
+        if benchmark:
+            save_ffmpeg_benchmark(job, f"converter-{os.path.basename(output_file)}.ffmpeg.txt", result.stderr)
         logger.info("Conversion complete: %s", output_file)
         return True
     except subprocess.CalledProcessError as e:
@@ -62,8 +100,13 @@ def send_combiner_job(job_payload):
 
 def callback(ch, method, properties, body):
     acked = False
+    span = None
+    profiler = None
+    job = {}
     try:
         job = json.loads(body.decode())
+        span = tracer.start_span(job)
+        profiler = start_profile(job)
         logger.info("Received converter job: %s", job)
 
         source_folder = job.get("source_folder")
@@ -73,12 +116,13 @@ def callback(ch, method, properties, body):
         metadata_key = job.get("metadata_key")
 
         converted_stems = []
+        register_artifacts(redis_client, job.get("job_id") or metadata_key, os.path.join(source_folder, "converted"))
         for stem in stems:
             source_file = os.path.join(source_folder, stem)
             output_folder = os.path.join(source_folder, "converted")
             os.makedirs(output_folder, exist_ok=True)
             output_file = os.path.join(output_folder, os.path.splitext(stem)[0] + ".mp3")
-            if convert_wav_to_mp3(source_file, output_file):
+            if convert_wav_to_mp3(source_file, output_file, job):
                 converted_stems.append(os.path.basename(output_file))
 
         ch.basic_ack(delivery_tag=method.delivery_tag)
@@ -90,18 +134,29 @@ def callback(ch, method, properties, body):
                 "stems": converted_stems,
                 "original_filename": original_filename,
                 "original_file": original_file,
-                "metadata_key": metadata_key
+                "metadata_key": metadata_key,
+                "job_id": job.get("job_id") or metadata_key,
+                "profile": job.get("profile", False),
+                "trace": tracer.trace_context(span)
             }
+            if job.get("render"):
+                combiner_job["render"] = job["render"]
             send_combiner_job(combiner_job)
         else:
             logger.warning("No stems were successfully converted; not sending combiner job.")
+        tracer.finish_span(span, path=original_file, stems=len(converted_stems))
     except Exception as e:
         logger.error("Error processing converter job: %s", e)
+        if span:
+            tracer.finish_span(span, error=str(e))
         if not acked:
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+    finally:
+        stop_profile(profiler, job, STAGE)
 
 if __name__ == "__main__":
     logger.info("Converter listening for jobs...")
+    start_http_server(METRICS_PORT)
     credentials = pika.PlainCredentials('admin', 'admin')
     connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
     channel = connection.channel()
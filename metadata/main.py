@@ -1,117 +1,318 @@
 #!/usr/bin/env python
 import os
 import json
-import pika
+import shutil
+import signal
+import asyncio
 import logging
-import redis
-import time
+from concurrent.futures import ThreadPoolExecutor
+import aio_pika
+import redis.asyncio as redis
 from mutagen.easyid3 import EasyID3
 from mutagen.id3 import ID3NoHeaderError
+from prometheus_client import start_http_server
+from kip.tracing import AsyncTracer
+from kip.profiling import run_profiled
+from kip.naming import instrumental_filename
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
 RABBITMQ_HOST = "rabbitmq"
 QUEUE_NAME = "metadata_jobs"
+CLEANUP_QUEUE = "cleanup_jobs"
+MUSIC_DIR = "/music"
+
+# Tagging is I/O bound, so one container keeps many jobs in flight: up to
+# CONSUMER_PREFETCH unacked messages, with file work on FILE_WORKERS threads.
+CONSUMER_PREFETCH = int(os.getenv("CONSUMER_PREFETCH", "100"))
+FILE_WORKERS = int(os.getenv("FILE_WORKERS", "8"))
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", "60"))  # seconds to finish in-flight jobs on shutdown
+# Batch mode (BATCH_SIZE > 1): collect up to BATCH_SIZE deliveries, or whatever
+# arrives within BATCH_WAIT_MS of the first, and handle them together.
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "1"))
+BATCH_WAIT_MS = int(os.getenv("BATCH_WAIT_MS", "200"))
 
 redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
+file_pool = ThreadPoolExecutor(max_workers=FILE_WORKERS)
+
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "metadata"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9006"))
+
+tracer = AsyncTracer(STAGE, redis_client)
 
-def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=15, delay=5):
+async def connect_to_rabbitmq_with_retries(host, max_attempts=15, delay=5):
     for attempt in range(1, max_attempts + 1):
         try:
             logger.info("Attempting RabbitMQ connection (%d/%d)...", attempt, max_attempts)
-            parameters = pika.ConnectionParameters(
-                host=host,
-                credentials=credentials,
-                heartbeat=600,
-                blocked_connection_timeout=300
-            )
-            connection = pika.BlockingConnection(parameters)
+            connection = await aio_pika.connect_robust(host=host, login='admin', password='admin', heartbeat=600)
             logger.info("Successfully connected to RabbitMQ on attempt %d.", attempt)
             return connection
         except Exception as e:
             logger.warning("RabbitMQ not ready (attempt %d/%d). Retrying in %d seconds...", attempt, max_attempts, delay)
-            time.sleep(delay)
+            await asyncio.sleep(delay)
     raise ConnectionError("Could not connect to RabbitMQ after multiple attempts.")
 
-def get_stored_metadata(metadata_key):
+async def get_stored_metadata(metadata_key):
     key = f"metadata:{metadata_key}"
-    return redis_client.hgetall(key)
+    return await redis_client.hgetall(key)
 
-def apply_metadata_from_store(final_file, metadata_key):
+def apply_metadata(final_file, metadata):
     try:
-        metadata = get_stored_metadata(metadata_key)
-        if not metadata:
-            logger.warning("No stored metadata found for key %s", metadata_key)
-            return
-        try:
-            final_meta = EasyID3(final_file)
-        except ID3NoHeaderError:
-            final_meta = EasyID3()
-        for field, value in metadata.items():
-            final_meta[field] = value
-        final_meta.save(final_file)
-        logger.info("Applied stored metadata to %s", final_file)
+        final_meta = EasyID3(final_file)
+    except ID3NoHeaderError:
+        final_meta = EasyID3()
+    for field, value in metadata.items():
+        final_meta[field] = value
+    final_meta.save(final_file)
+    logger.info("Applied stored metadata to %s", final_file)
+
+def reuse_output(job, metadata):
+    """
+    Copy the instrumental of an acoustically identical track (found by the
+    watcher's fingerprint lookup) to this track's canonical name in MUSIC_DIR.
+    """
+    canonical_name = instrumental_filename(metadata, job.get("original_filename") or job["metadata_key"])
+    final_file = os.path.join(MUSIC_DIR, canonical_name)
+    if os.path.abspath(final_file) != os.path.abspath(job["reuse_from"]):
+        shutil.copyfile(job["reuse_from"], final_file)
+    logger.info("Reused %s as %s", job["reuse_from"], final_file)
+    return final_file
+
+def replace_preview(job):
+    """Move a tagged full render over its preview in one rename."""
+    os.replace(job["final_file"], job["replaces"])
+    logger.info("Replaced preview %s with the full render", job["replaces"])
+    job["final_file"] = job["replaces"]
+
+async def record_fingerprint_outputs(jobs):
+    """Point the fingerprint index at the finished instrumental of every fingerprinted job."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for job in jobs:
+            pipe.exists(f"fingerprint:{job.get('metadata_key')}")
+        fingerprinted = await pipe.execute()
+        pipe = redis_client.pipeline(transaction=False)
+        for job, exists in zip(jobs, fingerprinted):
+            if exists:
+                pipe.hset(f"fingerprint:{job.get('metadata_key')}", "output", job.get("final_file"))
+        await pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to record fingerprint outputs: %s", e)
+
+async def apply_metadata_from_store(final_file, metadata_key, job=None):
+    try:
+        metadata = await get_stored_metadata(metadata_key)
+    except Exception as e:
+        logger.error("Error applying metadata to %s: %s", final_file, e)
+        return
+    if not metadata:
+        logger.warning("No stored metadata found for key %s", metadata_key)
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(file_pool, run_profiled, job or {}, STAGE, apply_metadata, final_file, metadata)
     except Exception as e:
         logger.error("Error applying metadata to %s: %s", final_file, e)
 
-def trigger_cleanup(original_file, final_file, cleanup_paths):
+async def trigger_cleanup(channel, original_file, final_file, cleanup_paths, trace=None, job_id=None, profile=False):
     cleanup_payload = {
         "cleanup_paths": cleanup_paths,
         "final_file": final_file,
-        "original_file": original_file
+        "original_file": original_file,
+        "job_id": job_id,
+        "profile": profile,
+        "trace": trace
     }
     try:
-        credentials = pika.PlainCredentials('admin', 'admin')
-        parameters = pika.ConnectionParameters(
-            host=RABBITMQ_HOST,
-            credentials=credentials,
-            heartbeat=600,
-            blocked_connection_timeout=300
-        )
-        connection = pika.BlockingConnection(parameters)
-        channel = connection.channel()
-        cleanup_queue = "cleanup_jobs"
-        channel.queue_declare(queue=cleanup_queue, durable=True)
-        channel.basic_publish(
-            exchange='',
-            routing_key=cleanup_queue,
-            body=json.dumps(cleanup_payload),
-            properties=pika.BasicProperties(delivery_mode=2)
+        await channel.default_exchange.publish(
+            aio_pika.Message(body=json.dumps(cleanup_payload).encode(), delivery_mode=aio_pika.DeliveryMode.PERSISTENT),
+            routing_key=CLEANUP_QUEUE
         )
-        connection.close()
         logger.info("Triggered cleanup for original: %s, final: %s", original_file, final_file)
     except Exception as e:
         logger.error("Failed to trigger cleanup: %s", e)
 
-def callback(ch, method, properties, body):
+async def process_job(job, channel):
+    span = tracer.start_span(job)
     try:
-        job = json.loads(body.decode())
         logger.info("Received metadata job: %s", job)
         final_file = job.get("final_file")
         original_file = job.get("original_file")
         metadata_key = job.get("metadata_key")
         cleanup_paths = job.get("cleanup_paths", [])
+        if job.get("reuse_from"):
+            metadata = await get_stored_metadata(metadata_key)
+            loop = asyncio.get_running_loop()
+            final_file = job["final_file"] = await loop.run_in_executor(file_pool, reuse_output, job, metadata)
         # Since metadata is now extracted early, we simply apply it.
-        apply_metadata_from_store(final_file, metadata_key)
-        # Trigger cleanup after metadata is applied.
-        trigger_cleanup(original_file, final_file, cleanup_paths)
-        ch.basic_ack(delivery_tag=method.delivery_tag)
+        await apply_metadata_from_store(final_file, metadata_key, job)
+        if job.get("replaces"):
+            await asyncio.get_running_loop().run_in_executor(file_pool, replace_preview, job)
+            final_file = job["final_file"]
+        if job.get("render") != "preview":
+            # A preview's original and stems are still needed for its full render.
+            await record_fingerprint_outputs([job])
+            await trigger_cleanup(channel, original_file, final_file, cleanup_paths, tracer.trace_context(span),
+                                  job.get("job_id"), job.get("profile", False))
+        await tracer.finish_span(span, path=final_file, job_id=job.get("job_id"), render=job.get("render"))
+    except Exception as e:
+        await tracer.finish_span(span, error=str(e))
+        raise
+
+async def handle_message(message, channel):
+    """Process one delivery and ack or nack it on its own, independently of the other in-flight jobs."""
+    try:
+        job = json.loads(message.body.decode())
+        await process_job(job, channel)
+        await message.ack()
     except Exception as e:
         logger.error("Error processing metadata job: %s", e)
-        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        await message.nack(requeue=False)
+
+async def process_batch(messages, channel):
+    """
+    Handle a batch of deliveries: one pipelined HGETALL for every metadata key,
+    tag writes spread over the file pool, failed items nacked one by one and
+    the rest settled with a single multiple=True ack.
+    """
+    loop = asyncio.get_running_loop()
+    jobs = []
+    failed = []
+    for message in messages:
+        try:
+            jobs.append((message, json.loads(message.body.decode())))
+        except Exception as e:
+            logger.error("Error processing metadata job: %s", e)
+            failed.append(message)
+    spans = [tracer.start_span(job) for _, job in jobs]
+    logger.info("Received metadata batch of %d jobs", len(messages))
 
-if __name__ == "__main__":
-    logger.info("Metadata Service listening for jobs...")
-    credentials = pika.PlainCredentials('admin', 'admin')
-    connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
-    channel = connection.channel()
-    channel.queue_declare(queue=QUEUE_NAME, durable=True)
-    channel.basic_qos(prefetch_count=1)
-    channel.basic_consume(queue=QUEUE_NAME, on_message_callback=callback)
     try:
-        channel.start_consuming()
-    except KeyboardInterrupt:
-        channel.stop_consuming()
-    finally:
-        connection.close()
+        pipe = redis_client.pipeline(transaction=False)
+        for _, job in jobs:
+            pipe.hgetall(f"metadata:{job.get('metadata_key')}")
+        stored = await pipe.execute()
+    except Exception as e:
+        logger.error("Error fetching metadata for batch: %s", e)
+        stored = [{}] * len(jobs)
+
+    async def tag(job, metadata):
+        if job.get("reuse_from"):
+            job["final_file"] = await loop.run_in_executor(file_pool, reuse_output, job, metadata or {})
+        if not metadata:
+            logger.warning("No stored metadata found for key %s", job.get("metadata_key"))
+        else:
+            await loop.run_in_executor(file_pool, run_profiled, job, STAGE, apply_metadata, job.get("final_file"), metadata)
+        if job.get("replaces"):
+            await loop.run_in_executor(file_pool, replace_preview, job)
+
+    results = await asyncio.gather(*(tag(job, metadata) for (_, job), metadata in zip(jobs, stored)),
+                                   return_exceptions=True)
+    succeeded = []
+    for (message, job), span, result in zip(jobs, spans, results):
+        if isinstance(result, Exception):
+            logger.error("Error applying metadata to %s: %s", job.get("final_file"), result)
+            await tracer.finish_span(span, error=str(result))
+            failed.append(message)
+            continue
+        if job.get("render") != "preview":
+            await trigger_cleanup(channel, job.get("original_file"), job.get("final_file"), job.get("cleanup_paths", []),
+                                  tracer.trace_context(span), job.get("job_id"), job.get("profile", False))
+        await tracer.finish_span(span, path=job.get("final_file"), job_id=job.get("job_id"), render=job.get("render"),
+                                 batch_size=len(messages))
+        succeeded.append(message)
+
+    await record_fingerprint_outputs([job for message, job in jobs
+                                      if message in succeeded and job.get("render") != "preview"])
+
+    # Nack failures first: the multiple=True ack below settles every
+    # outstanding delivery up to its tag, and batches run one at a time.
+    for message in failed:
+        await message.nack(requeue=False)
+    if succeeded:
+        await max(succeeded, key=lambda m: m.delivery_tag).ack(multiple=True)
+
+async def collect_batches(pending, channel):
+    """Feed deliveries from pending to process_batch until a None sentinel arrives."""
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        message = await pending.get()
+        if message is None:
+            return
+        batch = [message]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+        while len(batch) < BATCH_SIZE:
+            try:
+                message = await asyncio.wait_for(pending.get(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+            if message is None:
+                stopping = True
+                break
+            batch.append(message)
+        try:
+            await process_batch(batch, channel)
+        except Exception as e:
+            logger.error("Error processing metadata batch: %s", e)
+            for message in batch:
+                try:
+                    await message.nack(requeue=False)
+                except Exception:
+                    pass
+
+async def run():
+    start_http_server(METRICS_PORT)
+    connection = await connect_to_rabbitmq_with_retries(RABBITMQ_HOST)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=max(CONSUMER_PREFETCH, BATCH_SIZE))
+    await channel.declare_queue(CLEANUP_QUEUE, durable=True)
+    queue = await channel.declare_queue(QUEUE_NAME, durable=True)
+
+    in_flight = set()
+    pending = asyncio.Queue()
+    if BATCH_SIZE > 1:
+        batcher = asyncio.ensure_future(collect_batches(pending, channel))
+        in_flight.add(batcher)
+        batcher.add_done_callback(in_flight.discard)
+
+    async def on_message(message):
+        if BATCH_SIZE > 1:
+            await pending.put(message)
+            return
+        task = asyncio.ensure_future(handle_message(message, channel))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+
+    consumer_tag = await queue.consume(on_message)
+    logger.info("Metadata Service listening for jobs (prefetch=%d, batch size=%d)...", CONSUMER_PREFETCH, BATCH_SIZE)
+    await stop.wait()
+
+    # Graceful drain: stop deliveries, let in-flight jobs finish and ack, then
+    # close. Jobs still running after DRAIN_TIMEOUT are cancelled unacked, so
+    # RabbitMQ redelivers them.
+    logger.info("Shutting down; draining %d in-flight jobs...", len(in_flight))
+    await queue.cancel(consumer_tag)
+    await pending.put(None)
+    if in_flight:
+        _, still_running = await asyncio.wait(in_flight, timeout=DRAIN_TIMEOUT)
+        # Cancel what did not finish and wait for the cancellations to land, so no
+        # task still touches the channel, Redis or the file pool while they close.
+        if still_running:
+            logger.warning("Cancelling %d jobs still running after %ds.", len(still_running), DRAIN_TIMEOUT)
+            for task in still_running:
+                task.cancel()
+            await asyncio.gather(*still_running, return_exceptions=True)
+    await connection.close()
+    await redis_client.close()
+    file_pool.shutdown(wait=True)
+
+if __name__ == "__main__":
+    asyncio.run(run())
@@ -1,18 +1,32 @@
 #!/usr/bin/env python
 import os
+import math
 import time
 import json
 import pika
 import logging
 import redis
 import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from mutagen.mp3 import MP3
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
+from prometheus_client import Counter, start_http_server
+from kip.tracing import TRACE_TTL_SECONDS, Tracer, stamp_sent, trace_key
+from kip.profiling import start_profile, stop_profile
+from kip.artifacts import register_job_artifacts
+from kip.scratch import release_scratch, reservation_id, reserve_scratch
+from kip.stability import wait_for_stable_directory, wait_for_stable_file
+from kip.admission import (ADMISSION_POLL_SECONDS, SPLITTER_MAX_PRIORITY, PendingIndex, compute_job_priority,
+                           estimate_scratch_bytes)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
 PIPELINE_DIR = "/pipeline"
+STABILITY_TIME = 10  # seconds a dropped file must stop growing before it is hashed
 RABBITMQ_HOST = "rabbitmq"
 QUEUE_NAME = "splitter_jobs"
 
@@ -20,8 +34,37 @@ redis_host = os.getenv("REDIS_HOST", "redis")
 redis_port = int(os.getenv("REDIS_PORT", "6379"))
 redis_client = redis.StrictRedis(host=redis_host, port=redis_port, decode_responses=True)
 
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "queue"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9002"))
+
+CACHE_HITS = Counter("kip_cache_hits_total", "Work skipped because it was already done", ["stage", "cache"])
+
+tracer = Tracer(STAGE, redis_client)
+
 DEDUP_KEY = "submitted_jobs"
 
+# Admission control and shortest-job-first priorities live in kip.admission,
+# shared with the watcher.
+# Kept outside /pipeline so writing it does not trigger a watchdog event.
+PENDING_INDEX_FILE = os.getenv("PENDING_INDEX_FILE", "/originals/.queue_pending.json")
+SERVICE_NAME = "queue"
+# Full renders of previewed tracks, handed over by the splitter (must match it).
+FULL_RENDER_KEY = "full_render_requests"
+
+# Submission API: POST /jobs admits thousands of track/album paths at once and
+# GET /jobs/<job_id> reports where a job is. Job status lives in job:<job_id>.
+# Submitted files are consumed like /pipeline drops, so SUBMIT_ROOTS must only
+# list drop folders. The API has no authentication and listens on the
+# container's loopback unless SUBMIT_HOST says otherwise.
+SUBMIT_HOST = os.getenv("SUBMIT_HOST", "127.0.0.1")
+SUBMIT_PORT = int(os.getenv("SUBMIT_PORT", "9102"))
+SUBMIT_ROOTS = [os.path.realpath(p) for p in os.getenv("SUBMIT_ROOTS", "/pipeline").split(",")]
+SUBMIT_MAX_JOBS = int(os.getenv("SUBMIT_MAX_JOBS", "10000"))
+SUBMIT_WORKERS = int(os.getenv("SUBMIT_WORKERS", "8"))  # threads hashing submitted files
+PUBLISH_BATCH = int(os.getenv("PUBLISH_BATCH", "500"))  # jobs per confirmed publish
+JOB_STATUS_TTL = TRACE_TTL_SECONDS
+
 def compute_file_hash(file_path, hash_algo='md5'):
     hash_func = hashlib.new(hash_algo)
     with open(file_path, 'rb') as f:
@@ -29,6 +72,37 @@ def compute_file_hash(file_path, hash_algo='md5'):
             hash_func.update(chunk)
     return hash_func.hexdigest()
 
+def get_track_duration(file_path):
+    try:
+        return MP3(file_path).info.length
+    except Exception as e:
+        logger.warning("Failed to read duration from %s: %s", file_path, e)
+        return None
+
+def compute_job_id(path):
+    """
+    Content hash of a track, or of the sorted track hashes of an album folder.
+    An album without MP3s has no content to identify it and raises ValueError.
+    """
+    if not os.path.isdir(path):
+        return compute_file_hash(path)
+    tracks = sorted(name for name in os.listdir(path) if name.lower().endswith(".mp3"))
+    if not tracks:
+        raise ValueError(f"no MP3s in album folder {path}")
+    hash_func = hashlib.md5()
+    for name in tracks:
+        hash_func.update(compute_file_hash(os.path.join(path, name)).encode())
+    return hash_func.hexdigest()
+
+def get_job_duration(path):
+    """Duration of a track, or the summed duration of the MP3s in an album folder."""
+    if os.path.isdir(path):
+        durations = [get_track_duration(os.path.join(path, f)) for f in os.listdir(path) if f.lower().endswith(".mp3")]
+        if not durations or None in durations:
+            return None
+        return sum(durations)
+    return get_track_duration(path)
+
 def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=15, delay=5):
     for attempt in range(1, max_attempts + 1):
         try:
@@ -47,65 +121,421 @@ def connect_to_rabbitmq_with_retries(host, credentials, max_attempts=15, delay=5
             time.sleep(delay)
     raise ConnectionError("Could not connect to RabbitMQ after multiple attempts.")
 
+def connect_for_depth():
+    credentials = pika.PlainCredentials('admin', 'admin')
+    return connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials, max_attempts=1, delay=0)
+
+def publish_jobs(jobs):
+    """
+    Publish jobs in order over one connection with publisher confirms, so each
+    one is known to be on the broker. Returns how many were confirmed; those
+    are then marked submitted (dedup set and job status) in one pipelined call.
+    Scratch space is reserved before publishing, so the splitter can never
+    release a reservation that does not exist yet.
+    """
+    published = 0
+    update_reservations(jobs, reserve=True)
+    try:
+        credentials = pika.PlainCredentials('admin', 'admin')
+        connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
+        try:
+            channel = connection.channel()
+            channel.queue_declare(queue=QUEUE_NAME, durable=True, arguments={"x-max-priority": SPLITTER_MAX_PRIORITY})
+            channel.confirm_delivery()
+            for job in jobs:
+                stamp_sent(job)
+                channel.basic_publish(
+                    exchange='',
+                    routing_key=QUEUE_NAME,
+                    body=json.dumps(job, sort_keys=True),
+                    properties=pika.BasicProperties(delivery_mode=2, priority=job["priority"]),
+                    mandatory=True
+                )
+                published += 1
+        finally:
+            connection.close()
+    except Exception as e:
+        logger.error("Failed to send job to queue (%d of %d confirmed): %s", published, len(jobs), e)
+    if published < len(jobs):
+        update_reservations(jobs[published:], reserve=False)
+    if published:
+        set_job_status(jobs[:published], "queued", published=True)
+        logger.info("Sent %d jobs to queue.", published)
+    return published
+
+def update_reservations(jobs, reserve):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for job in jobs:
+            if reserve:
+                reserve_scratch(pipe, job, estimate_scratch_bytes(job.get("duration")))
+            else:
+                release_scratch(pipe, job)
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to update scratch reservations for %d jobs: %s", len(jobs), e)
+
+def set_job_status(jobs, status, published=False):
+    """Record the jobs' status; published jobs also join the dedup set."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for job in jobs:
+            key = f"job:{job['job_id']}"
+            pipe.hset(key, mapping={
+                "path": job["path"],
+                "status": status,
+                "trace_id": job["trace"]["trace_id"],
+                "updated_at": time.time()
+            })
+            pipe.expire(key, JOB_STATUS_TTL)
+            if published:
+                pipe.sadd(DEDUP_KEY, job["job_id"])
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to record status for %d jobs: %s", len(jobs), e)
+
+class SubmissionIndex(PendingIndex):
+    """The queue's pending index: also deduplicates admissions and tracks job status."""
+
+    def add_many(self, jobs):
+        super().add_many(jobs)
+        set_job_status(jobs, "pending")
+
+    def add_new(self, jobs):
+        """
+        Add the jobs that are neither pending nor published yet and return them.
+        The dedup check runs under the index lock, and release() only moves jobs
+        from the index into the dedup set under that lock, so two concurrent
+        submissions of the same job can never both get in.
+        """
+        with self.lock:
+            pipe = redis_client.pipeline(transaction=False)
+            for job in jobs:
+                pipe.sismember(DEDUP_KEY, job["job_id"])
+            submitted = pipe.execute()
+            seen = {j.get("job_id") for j in self.jobs}
+            new_jobs = []
+            for job, already in zip(jobs, submitted):
+                if already or job["job_id"] in seen:
+                    continue
+                seen.add(job["job_id"])
+                new_jobs.append(job)
+            if new_jobs:
+                self.append(new_jobs)
+        if new_jobs:
+            set_job_status(new_jobs, "pending")
+        return new_jobs
+
+    def take_full_renders(self):
+        """
+        Move the full renders the splitter requested into the index. The list is
+        trimmed only after the index is saved; a render already in the index
+        (from a crash in between) is not added twice.
+        """
+        requests = redis_client.lrange(FULL_RENDER_KEY, 0, -1)
+        if not requests:
+            return 0
+        with self.lock:
+            present = {reservation_id(j) for j in self.jobs if j.get("job_id")}
+        jobs = [job for job in map(json.loads, requests) if reservation_id(job) not in present]
+        if jobs:
+            self.add_many(jobs)
+        redis_client.ltrim(FULL_RENDER_KEY, len(requests), -1)
+        return len(jobs)
+
+pending_index = SubmissionIndex(PENDING_INDEX_FILE, SERVICE_NAME, redis_client, connect_for_depth, publish_jobs,
+                                batch_size=PUBLISH_BATCH)
+
+def admit_jobs(jobs, spans):
+    """
+    Admission shared by /pipeline drops and the submission API: give each
+    identified job its priority and trace context, claim the new ones in the
+    pending index, and register their paths for cleanup. Returns the jobs that
+    were admitted; the rest were duplicates.
+    """
+    for job, span in zip(jobs, spans):
+        # A "sing next" request jumps ahead of everything already queued.
+        job["priority"] = compute_job_priority(job["duration"], sing_next=job.get("sing_next", False))
+        job["trace"] = tracer.trace_context(span)
+        span.update(path=job["path"], job_id=job["job_id"])
+    admitted = pending_index.add_new(jobs)
+    CACHE_HITS.labels(STAGE, "dedup").inc(len(jobs) - len(admitted))
+    if admitted:
+        admitted_ids = {id(job) for job in admitted}
+        register_job_artifacts(redis_client, {job["job_id"]: [job["path"]] for job in admitted})
+        tracer.finish_spans([span for job, span in zip(jobs, spans) if id(job) in admitted_ids])
+    return admitted
+
 def send_to_queue(job: dict):
+    span = tracer.start_span(job)
+    profiler = start_profile(job)
     try:
-        # Compute a unique job id (using the metadata_key if present, or a hash of the path)
-        job_id = job.get("metadata_key") or compute_file_hash(job["path"])
-        # Use a fixed key so that duplicate jobs can be detected.
-        if redis_client.sismember(DEDUP_KEY, job_id):
-            logger.info("Job already submitted (job_id=%s); skipping duplicate.", job_id)
+        error = identify_job(job)
+        if error:
+            raise ValueError(error)
+        if not admit_jobs([job], [span]):
+            logger.info("Job already submitted (job_id=%s); skipping duplicate.", job["job_id"])
             return
+        pending_index.release()
+    except Exception as e:
+        logger.error("Failed to send job to queue: %s", e)
+    finally:
+        stop_profile(profiler, job, STAGE)
 
-        # Add the job_id to the payload so that downstream services can also use it if needed.
-        job["job_id"] = job_id
+def submittable(path):
+    """An existing path strictly inside one of SUBMIT_ROOTS, once symlinks and ".." are resolved."""
+    path = os.path.realpath(path)
+    return os.path.exists(path) and any(path.startswith(root + os.sep) for root in SUBMIT_ROOTS)
 
-        payload = json.dumps(job, sort_keys=True)
-        credentials = pika.PlainCredentials('admin', 'admin')
-        connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
-        channel = connection.channel()
-        channel.queue_declare(queue=QUEUE_NAME, durable=True)
-        channel.basic_publish(
-            exchange='',
-            routing_key=QUEUE_NAME,
-            body=payload,
-            properties=pika.BasicProperties(delivery_mode=2)
-        )
-        connection.close()
-        redis_client.sadd(DEDUP_KEY, job_id)
-        logger.info("Sent job to queue: %s", payload)
+def parse_duration(value):
+    """A duration given with a job, as seconds; raises ValueError unless it is a positive number."""
+    try:
+        duration = float(value)
+    except (TypeError, ValueError):
+        duration = None
+    if isinstance(value, bool) or duration is None or not math.isfinite(duration) or duration <= 0:
+        raise ValueError(f"duration must be a positive number of seconds, not {value!r}")
+    return duration
+
+def identify_job(job):
+    """Hash and read the duration of one job (on a worker thread for submissions); returns an error string or None."""
+    try:
+        # The content hash is the job_id and the dedup key. It is never taken
+        # from the job itself: a chosen id would skip dedup and could overwrite
+        # another job's status and artifacts.
+        job["job_id"] = compute_job_id(job["path"])
+        if job.get("type") == "album":
+            job.pop("metadata_key", None)  # the splitter hashes each album track itself
+        else:
+            job["metadata_key"] = job["job_id"]
+        if job.get("duration") is None:
+            job["duration"] = get_job_duration(job["path"])
+        else:
+            job["duration"] = parse_duration(job["duration"])
+        return None
     except Exception as e:
-        logger.error("Failed to send job to queue: %s", e)
+        return str(e)
+
+def submit_jobs(requests):
+    """
+    Admit many jobs at once. Files are hashed on SUBMIT_WORKERS threads, the
+    whole batch is checked against the dedup set in one pipelined Redis call,
+    and the new jobs go into the pending index with a single save (see
+    admit_jobs) before admission control releases what the pipeline can take.
+    Returns one {"path", "job_id", "status"} result per request, in order.
+    """
+    jobs = []
+    results = []
+    for request in requests:
+        job = {"path": request} if isinstance(request, str) else dict(request) if isinstance(request, dict) else {}
+        path = job.get("path")
+        if not isinstance(path, str) or not submittable(path):
+            results.append({"path": path, "status": "invalid", "error": "path not found under " + ", ".join(SUBMIT_ROOTS)})
+            continue
+        job["path"] = os.path.realpath(path)
+        job["type"] = "album" if os.path.isdir(path) else "track"
+        results.append({"path": path})
+        jobs.append((job, results[-1]))
+
+    with ThreadPoolExecutor(max_workers=SUBMIT_WORKERS) as pool:
+        errors = list(pool.map(identify_job, [job for job, _ in jobs]))
+
+    identified = []
+    for (job, result), error in zip(jobs, errors):
+        if error:
+            result.update(status="invalid", error=error)
+            continue
+        result["job_id"] = job["job_id"]
+        identified.append((job, result))
+
+    new_jobs = admit_jobs([job for job, _ in identified], [tracer.start_span(job) for job, _ in identified]) if identified else []
+    admitted_ids = {id(job) for job in new_jobs}
+    for job, result in identified:
+        result["status"] = "pending" if id(job) in admitted_ids else "duplicate"
+
+    if new_jobs:
+        pending_index.release()
+        still_pending = pending_index.job_ids()
+        for result in results:
+            if result.get("status") == "pending" and result["job_id"] not in still_pending:
+                result["status"] = "queued"
+    logger.info("Submission of %d jobs: %d new, %d duplicate, %d invalid.", len(results), len(new_jobs),
+                sum(r["status"] == "duplicate" for r in results), sum(r["status"] == "invalid" for r in results))
+    return results
+
+def job_done(job_id, spans):
+    """
+    A track is done once the metadata stage has finished its full render (a
+    preview does not count). An album is done once that holds for every track
+    the splitter dispatched under its child job_ids (<job_id>/<n>).
+    """
+    finished = {span.get("job_id") for span in spans
+                if span["stage"] == "metadata" and not span.get("error") and span.get("render") != "preview"}
+    if job_id in finished:
+        return True
+    albums = [span for span in spans if span["stage"] == "splitter" and "tracks" in span]
+    if not albums:
+        return False
+    tracks_done = sum(1 for finished_id in finished if finished_id and finished_id.startswith(job_id + "/"))
+    return tracks_done >= albums[-1]["tracks"]
+
+def job_statuses(job_ids):
+    """
+    Status of each job: its admission state from job:<job_id>, refined by the
+    spans its trace has collected downstream. One pipelined call per step.
+    """
+    pipe = redis_client.pipeline(transaction=False)
+    for job_id in job_ids:
+        pipe.hgetall(f"job:{job_id}")
+    records = pipe.execute()
+    pipe = redis_client.pipeline(transaction=False)
+    for record in records:
+        pipe.lrange(trace_key(record.get("trace_id", "")), 0, -1)
+    traces = pipe.execute()
+
+    statuses = []
+    for job_id, record, trace in zip(job_ids, records, traces):
+        if not record:
+            statuses.append({"job_id": job_id, "status": "unknown"})
+            continue
+        spans = [json.loads(span) for span in trace]
+        stages = [span["stage"] for span in spans if span["stage"] != STAGE]
+        status = record["status"]
+        if any(span.get("error") for span in spans):
+            status = "failed"
+        elif job_done(job_id, spans):
+            status = "done"
+        elif stages:
+            status = "processing"
+        statuses.append({
+            "job_id": job_id,
+            "path": record.get("path"),
+            "status": status,
+            "stages": stages,
+            "trace_id": record.get("trace_id")
+        })
+    return statuses
+
+class SubmitHandler(BaseHTTPRequestHandler):
+    """
+    POST /jobs           {"jobs": ["/pipeline/a.mp3", {"path": "/pipeline/album", "sing_next": true}, ...]}
+    POST /jobs/status    {"job_ids": ["...", ...]}
+    GET  /jobs/<job_id>
+    """
+
+    def send_json(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_POST(self):
+        try:
+            body = self.read_json()
+        except ValueError:
+            return self.send_json(400, {"error": "body must be JSON"})
+        if self.path == "/jobs":
+            requests = body.get("jobs") if isinstance(body, dict) else body
+            if not isinstance(requests, list):
+                return self.send_json(400, {"error": "expected a list of jobs"})
+            if len(requests) > SUBMIT_MAX_JOBS:
+                return self.send_json(413, {"error": f"at most {SUBMIT_MAX_JOBS} jobs per request"})
+            try:
+                return self.send_json(202, {"jobs": submit_jobs(requests)})
+            except Exception as e:
+                logger.error("Bulk submission failed: %s", e)
+                return self.send_json(503, {"error": str(e)})
+        if self.path == "/jobs/status":
+            job_ids = body.get("job_ids") if isinstance(body, dict) else None
+            if not isinstance(job_ids, list):
+                return self.send_json(400, {"error": "expected job_ids"})
+            return self.send_json(200, {"jobs": job_statuses(job_ids)})
+        self.send_json(404, {"error": "not found"})
+
+    def do_GET(self):
+        if self.path.startswith("/jobs/"):
+            status = job_statuses([self.path[len("/jobs/"):]])[0]
+            return self.send_json(404 if status["status"] == "unknown" else 200, status)
+        self.send_json(404, {"error": "not found"})
+
+    def log_message(self, format, *args):
+        logger.debug("Submission API: " + format, *args)
+
+def start_submit_server(port):
+    server = ThreadingHTTPServer((SUBMIT_HOST, port), SubmitHandler)
+    threading.Thread(target=server.serve_forever, name="submit-api", daemon=True).start()
+    logger.info("Submission API listening on %s:%d.", SUBMIT_HOST, port)
+    return server
 
 class PipelineHandler(FileSystemEventHandler):
+    """
+    Turns MP3s and album folders dropped into /pipeline into jobs. A sidecar
+    <name>.job descriptor adds options to the job for <name>; it is never a
+    job itself.
+    """
+
     def on_created(self, event):
+        path = event.src_path
+        if path.endswith(".job"):
+            # A descriptor written after its target: the target's own event may
+            # have come before the descriptor existed. A repeat is deduplicated.
+            target = path[:-len(".job")]
+            if os.path.exists(target):
+                self.handle(target)
+            return
+        if not event.is_directory and not path.lower().endswith(".mp3"):
+            logger.debug("Ignoring %s: not an MP3 or an album folder.", path)
+            return
+        self.handle(path)
+
+    def handle(self, path):
+        # Hash only once the copy has finished, or the job_id would name a partial file.
+        if os.path.isdir(path):
+            wait_for_stable_directory(path)
+            if not any(name.lower().endswith(".mp3") for name in os.listdir(path)):
+                logger.warning("Ignoring album folder %s: it has no MP3s. Drop it again once it has.", path)
+                return
+        elif not wait_for_stable_file(path, STABILITY_TIME):
+            logger.warning("%s disappeared before it finished copying.", path)
+            return
+        job = {}
         try:
-            with open(event.src_path + ".job", "r") as f:
+            with open(path + ".job", "r") as f:
                 job = json.load(f)
-            payload = json.dumps(job)
-            send_to_queue(payload)
+        except FileNotFoundError:
+            pass
         except Exception as e:
-            job = {
-                "type": "album" if os.path.isdir(event.src_path) else "track",
-                "path": event.src_path,
-            }
-            if event.src_path.lower().endswith(".mp3"):
-                try:
-                    file_hash = compute_file_hash(event.src_path)
-                    job["metadata_key"] = file_hash
-                except Exception as hash_err:
-                    logger.error("Error computing metadata_key for %s: %s", event.src_path, hash_err)
-            payload = json.dumps(job)
-            send_to_queue(payload)
+            logger.error("Ignoring unreadable descriptor %s.job: %s", path, e)
+        if not isinstance(job, dict):
+            logger.error("Ignoring descriptor %s.job: not a JSON object.", path)
+            job = {}
+        # The sidecar describes this path; the id is always the content hash (see identify_job).
+        job["path"] = path
+        job["type"] = "album" if os.path.isdir(path) else "track"
+        send_to_queue(job)
 
 if __name__ == "__main__":
     logger.info("Starting Queue Manager. Watching %s...", PIPELINE_DIR)
+    start_http_server(METRICS_PORT)
+    start_submit_server(SUBMIT_PORT)
     event_handler = PipelineHandler()
     observer = Observer()
     observer.schedule(event_handler, PIPELINE_DIR, recursive=False)
     observer.start()
     try:
         while True:
-            time.sleep(1)
+            time.sleep(ADMISSION_POLL_SECONDS)
+            try:
+                pending_index.take_full_renders()
+            except Exception as e:
+                logger.warning("Failed to take requested full renders: %s", e)
+            pending_index.release()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
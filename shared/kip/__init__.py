@@ -0,0 +1,7 @@
+"""
+Helpers shared by the pipeline services.
+
+Each service image copies this package next to its main.py (see the
+additional_contexts in docker-compose.yml); the benchmark and bulk mode put
+shared/ on sys.path instead.
+"""
@@ -0,0 +1,184 @@
+"""
+Admission control for the two services that feed splitter_jobs (the watcher
+and the queue).
+
+splitter_jobs is a RabbitMQ priority queue: shorter tracks are published with
+a higher priority, and the top priority is reserved for manual "sing next"
+requests. New jobs wait in a local pending index while the downstream queues
+are too deep or /splitter_output is about to run out of space, and are
+released highest priority first.
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+
+from kip.artifacts import mark_waiting
+from kip.scratch import reserved_scratch_bytes
+
+logger = logging.getLogger(__name__)
+
+# Must match the splitter's declaration, otherwise RabbitMQ rejects the declare.
+SPLITTER_MAX_PRIORITY = int(os.getenv("SPLITTER_MAX_PRIORITY", "10"))
+PRIORITY_BUCKET_SECONDS = int(os.getenv("PRIORITY_BUCKET_SECONDS", "300"))
+
+SPLITTER_OUTPUT_DIR = "/splitter_output"
+BACKPRESSURE_QUEUES = os.getenv("BACKPRESSURE_QUEUES", "splitter_jobs,converter_jobs,combiner_jobs").split(",")
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "50"))
+MIN_FREE_SCRATCH_BYTES = int(os.getenv("MIN_FREE_SCRATCH_MB", "2048")) * 1024 * 1024
+SCRATCH_BYTES_PER_SECOND = 5 * 44100 * 2 * 2  # five 16-bit stereo WAV stems
+DEFAULT_DURATION = 300  # seconds, used when a track's duration is unknown
+ADMISSION_POLL_SECONDS = int(os.getenv("ADMISSION_POLL_SECONDS", "15"))
+PENDING_COUNT_KEY = "admission_pending"  # hash: service -> jobs held back
+
+def compute_job_priority(duration, sing_next=False):
+    """
+    Map a track duration to a splitter_jobs priority: one level per
+    PRIORITY_BUCKET_SECONDS, shortest tracks first. Unknown durations land
+    in the middle so they neither starve nor jump ahead of short singles.
+    """
+    if sing_next:
+        return SPLITTER_MAX_PRIORITY
+    if duration is None:
+        return SPLITTER_MAX_PRIORITY // 2
+    bucket = int(duration // PRIORITY_BUCKET_SECONDS)
+    return max(0, SPLITTER_MAX_PRIORITY - 1 - bucket)
+
+def estimate_scratch_bytes(duration):
+    return int((duration or DEFAULT_DURATION) * SCRATCH_BYTES_PER_SECOND)
+
+def get_queue_depth(connection, queues):
+    """Messages waiting in queues, read with passive declares on an open pika connection."""
+    import pika
+    depth = 0
+    for queue in queues:
+        # A passive declare on a missing queue closes the channel, so use one per queue.
+        channel = connection.channel()
+        try:
+            depth += channel.queue_declare(queue=queue, passive=True).method.message_count
+            channel.close()
+        except pika.exceptions.ChannelClosedByBroker:
+            pass
+    return depth
+
+def has_capacity(job, queue_depth, reserved_bytes):
+    """
+    A job is admitted while the backlog is below MAX_QUEUE_DEPTH and the free
+    space left on /splitter_output, once this job and every published job whose
+    stems are not on disk yet (reserved_bytes) have written theirs, stays above
+    MIN_FREE_SCRATCH_MB. "Sing next" requests skip the depth check so they are
+    never stuck behind the backlog.
+    """
+    if queue_depth >= MAX_QUEUE_DEPTH and not job.get("sing_next"):
+        return False
+    if not os.path.isdir(SPLITTER_OUTPUT_DIR):
+        return True
+    free_bytes = shutil.disk_usage(SPLITTER_OUTPUT_DIR).free
+    projected_free = free_bytes - reserved_bytes - estimate_scratch_bytes(job.get("duration"))
+    return projected_free >= MIN_FREE_SCRATCH_BYTES
+
+class PendingIndex:
+    """
+    Jobs held back by admission control, persisted so a restart does not lose
+    them. connect() opens the RabbitMQ connection used to read queue depths;
+    publish(jobs) publishes a batch in order (reserving its scratch first) and
+    returns how many were published.
+    """
+
+    def __init__(self, path, service_name, redis_client, connect, publish, batch_size=1):
+        self.path = path
+        self.service_name = service_name
+        self.redis_client = redis_client
+        self.connect = connect
+        self.publish = publish
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.jobs = self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except Exception as e:
+            logger.error("Failed to load pending index %s: %s", self.path, e)
+            return []
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.jobs, f)
+        os.replace(tmp_path, self.path)
+        try:
+            self.redis_client.hset(PENDING_COUNT_KEY, self.service_name, len(self.jobs))
+        except Exception as e:
+            logger.warning("Failed to publish pending count: %s", e)
+
+    def add(self, job):
+        self.add_many([job])
+
+    def add_many(self, jobs):
+        with self.lock:
+            self.append(jobs)
+
+    def append(self, jobs):
+        """Add jobs to the index; the caller holds the lock."""
+        # Marked before they are saved: a pending job's original must never be
+        # reclaimed by the artifact TTL, however long admission holds it.
+        mark_waiting(self.redis_client, [job.get("job_id") for job in jobs])
+        self.jobs.extend(jobs)
+        self.save()
+        logger.info("Queued %d jobs for admission (%d pending).", len(jobs), len(self.jobs))
+
+    def job_ids(self):
+        with self.lock:
+            return {j.get("job_id") for j in self.jobs}
+
+    def count(self):
+        with self.lock:
+            return len(self.jobs)
+
+    def read_capacity(self):
+        """(queue depth, reserved scratch bytes) as admission sees them now."""
+        connection = self.connect()
+        try:
+            queue_depth = get_queue_depth(connection, BACKPRESSURE_QUEUES)
+        finally:
+            connection.close()
+        return queue_depth, reserved_scratch_bytes(self.redis_client)
+
+    def release(self):
+        """Publish pending jobs, highest priority first, until capacity runs out."""
+        with self.lock:
+            if not self.jobs:
+                return 0
+            try:
+                queue_depth, reserved_bytes = self.read_capacity()
+            except Exception as e:
+                logger.warning("Could not read queue depth or scratch reservations; holding %d pending jobs: %s", len(self.jobs), e)
+                return 0
+            self.jobs.sort(key=lambda j: j.get("priority", 0), reverse=True)
+            released = 0
+            while released < len(self.jobs):
+                batch = []
+                batch_bytes = 0
+                for job in self.jobs[released:released + self.batch_size]:
+                    if not has_capacity(job, queue_depth + len(batch), reserved_bytes + batch_bytes):
+                        break
+                    batch.append(job)
+                    batch_bytes += estimate_scratch_bytes(job.get("duration"))
+                if not batch:
+                    break
+                published = self.publish(batch)
+                released += published
+                queue_depth += published
+                reserved_bytes += sum(estimate_scratch_bytes(job.get("duration")) for job in batch[:published])
+                if published < len(batch):
+                    break
+            del self.jobs[:released]
+            self.save()
+            if self.jobs:
+                logger.info("Admission control: released %d jobs, %d still pending.", released, len(self.jobs))
+            return released
@@ -0,0 +1,113 @@
+"""
+Artifact registry: every intermediate file a stage creates is recorded
+against its job_id (artifacts:<job_id>, with a reverse artifact_refs:<path>
+set). The cleanup service reclaims them once the job is finalised, or once
+it has been idle for longer than its TTL.
+
+A job can be split into child jobs (an album into its tracks): each child
+registers and finalises its own artifacts, and the parent is finalised once
+its last child is.
+
+Jobs that have not reached the splitter yet (held by admission control,
+queued in splitter_jobs, or a full render waiting behind its preview) are
+kept in WAITING_KEY, and the idle-TTL sweep leaves their artifacts alone.
+"""
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+ARTIFACT_JOBS_KEY = "artifact_jobs"  # sorted set: job_id -> last registration time
+FINALIZED_KEY = "artifact_finalized"  # set of job_ids whose artifacts can be reclaimed
+WAITING_KEY = "artifact_waiting"  # set of job_ids not yet picked up by the splitter
+
+def artifacts_key(job_id):
+    return f"artifacts:{job_id}"
+
+def artifact_refs_key(path):
+    return f"artifact_refs:{path}"
+
+def children_key(job_id):
+    return f"artifact_children:{job_id}"
+
+def parent_key(job_id):
+    return f"artifact_parent:{job_id}"
+
+def queue_artifacts(pipe, job_id, paths):
+    """Add the registration of paths under job_id to a Redis pipeline (sync or asyncio)."""
+    for path in paths:
+        pipe.sadd(artifacts_key(job_id), path)
+        pipe.sadd(artifact_refs_key(path), job_id)
+    pipe.zadd(ARTIFACT_JOBS_KEY, {job_id: time.time()})
+
+def register_artifacts(redis_client, job_id, *paths):
+    if job_id:
+        register_job_artifacts(redis_client, {job_id: paths})
+
+def register_job_artifacts(redis_client, artifacts):
+    """register_artifacts for many jobs ({job_id: paths}) in one pipelined call."""
+    if not artifacts:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for job_id, paths in artifacts.items():
+            queue_artifacts(pipe, job_id, paths)
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to register artifacts for job %s: %s", ", ".join(artifacts), e)
+
+def register_children(redis_client, job_id, child_ids):
+    """Split job_id into child jobs; register them all before any of them can finish."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        if child_ids:
+            pipe.sadd(children_key(job_id), *child_ids)
+        for child_id in child_ids:
+            pipe.set(parent_key(child_id), job_id)
+        pipe.zadd(ARTIFACT_JOBS_KEY, {job_id: time.time()})
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to register child jobs of %s: %s", job_id, e)
+
+def mark_waiting(redis_client, job_ids):
+    """Keep the TTL sweep away from these jobs until the splitter picks them up."""
+    job_ids = [job_id for job_id in job_ids if job_id]
+    if not job_ids:
+        return
+    try:
+        redis_client.sadd(WAITING_KEY, *job_ids)
+    except Exception as e:
+        logger.warning("Failed to mark %d jobs as waiting: %s", len(job_ids), e)
+
+def mark_consumed(redis_client, job_id):
+    """The splitter has the job: its artifacts age from now on like any other job's."""
+    if not job_id:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.srem(WAITING_KEY, job_id)
+        pipe.zadd(ARTIFACT_JOBS_KEY, {job_id: time.time()})
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to mark job %s as consumed: %s", job_id, e)
+
+def finalize_job(redis_client, job_id):
+    """Hand job_id's artifacts to the cleanup service's GC, and its parent's once every sibling is finalised too."""
+    try:
+        redis_client.sadd(FINALIZED_KEY, job_id)
+        parent = redis_client.get(parent_key(job_id))
+        if parent:
+            redis_client.srem(children_key(parent), job_id)
+            if not redis_client.scard(children_key(parent)):
+                redis_client.sadd(FINALIZED_KEY, parent)
+    except Exception as e:
+        logger.warning("Failed to finalise job %s: %s", job_id, e)
+
+async def finalize_job_async(redis_client, job_id):
+    """finalize_job for a redis.asyncio client; errors propagate to the caller."""
+    await redis_client.sadd(FINALIZED_KEY, job_id)
+    parent = await redis_client.get(parent_key(job_id))
+    if parent:
+        await redis_client.srem(children_key(parent), job_id)
+        if not await redis_client.scard(children_key(parent)):
+            await redis_client.sadd(FINALIZED_KEY, parent)
@@ -0,0 +1,19 @@
+"""
+Library file names.
+
+The combiner, the metadata stage's fingerprint reuse and bulk mode must all
+agree on where a track's instrumental lives in /music.
+"""
+import os
+
+def instrumental_filename(metadata, original_filename):
+    """
+    Canonical name of a track's instrumental: "%title% - %artist% - (Instrumental).mp3"
+    when both tags are set, "<original name>_combined.mp3" otherwise.
+    """
+    title = (metadata.get("title") or "").strip() if metadata else ""
+    artist = (metadata.get("artist") or "").strip() if metadata else ""
+    if title and artist:
+        return f"{title} - {artist} - (Instrumental).mp3"
+    base, _ = os.path.splitext(original_filename)
+    return f"{base}_combined.mp3"
@@ -0,0 +1,60 @@
+"""
+On-demand profiling: set "profile": true in a job (or PROFILE_ALL_JOBS=true)
+and every stage writes its artifacts to PROFILE_DIR/<job_id>/.
+"""
+import cProfile
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = "/profiles"
+PROFILE_ALL_JOBS = os.getenv("PROFILE_ALL_JOBS", "false").lower() in ("1", "true", "yes")
+
+def profiling_enabled(job):
+    return PROFILE_ALL_JOBS or bool(job.get("profile"))
+
+def profile_artifact_path(job, name):
+    """Free path for an artifact under PROFILE_DIR/<job_id>/, suffixed if the name is taken (album jobs)."""
+    job_id = job.get("job_id") or job.get("metadata_key") or "unknown"
+    folder = os.path.join(PROFILE_DIR, job_id)
+    os.makedirs(folder, exist_ok=True)
+    base, ext = os.path.splitext(name)
+    path = os.path.join(folder, name)
+    counter = 2
+    while os.path.exists(path):
+        path = os.path.join(folder, f"{base}-{counter}{ext}")
+        counter += 1
+    return path
+
+def start_profile(job):
+    """Start a CPU profile of the stage's Python code; returns None (and costs nothing) when profiling is off."""
+    if not profiling_enabled(job):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def stop_profile(profiler, job, stage):
+    """Write the profile started by start_profile to PROFILE_DIR/<job_id>/<stage>.prof."""
+    if profiler is None:
+        return
+    profiler.disable()
+    try:
+        path = profile_artifact_path(job, f"{stage}.prof")
+        profiler.dump_stats(path)
+        logger.info("Wrote CPU profile to %s", path)
+    except Exception as e:
+        logger.warning("Failed to write CPU profile: %s", e)
+
+def run_profiled(job, stage, func, *args):
+    """
+    Run func on the calling (pool) thread, profiled when the job asks for it.
+    cProfile only sees its own thread, so this profiles the file work and not
+    the jobs sharing an event loop.
+    """
+    profiler = start_profile(job)
+    try:
+        return func(*args)
+    finally:
+        stop_profile(profiler, job, stage)
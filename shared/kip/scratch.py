@@ -0,0 +1,36 @@
+"""
+Scratch-space reservations for admission control.
+
+Free space on /splitter_output already accounts for stems that have been
+written, so admission only has to account for jobs that were published but
+whose stems are not on disk yet. Each published job reserves its estimated
+stem size in the scratch_reserved hash until the splitter is done with it.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_RESERVED_KEY = "scratch_reserved"  # hash: reservation id -> estimated stem bytes
+RENDERS = ("first", "full")  # a preview-first job is published twice
+
+def reservation_id(job):
+    return f"{job['job_id']}:{job.get('render') or 'first'}"
+
+def reserve_scratch(client, job, nbytes):
+    """Reserve nbytes for a published job; client may be a Redis pipeline."""
+    client.hset(SCRATCH_RESERVED_KEY, reservation_id(job), nbytes)
+
+def release_scratch(client, job):
+    if not job.get("job_id"):
+        return
+    try:
+        client.hdel(SCRATCH_RESERVED_KEY, reservation_id(job))
+    except Exception as e:
+        logger.warning("Failed to release the scratch reservation of job %s: %s", job["job_id"], e)
+
+def reservation_ids(job_id):
+    """Every reservation a job can hold, for dropping those of a job that never finished."""
+    return [f"{job_id}:{render}" for render in RENDERS]
+
+def reserved_scratch_bytes(client):
+    return sum(int(v) for v in client.hvals(SCRATCH_RESERVED_KEY))
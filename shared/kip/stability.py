@@ -0,0 +1,51 @@
+"""
+Waiting for dropped files to finish arriving.
+
+The watcher and the queue service both react to files being created, which
+happens before a copy or download has finished writing them. A file is only
+hashed or moved once it has stopped growing.
+"""
+import os
+import time
+
+def wait_for_stable_file(path, interval, settled=False):
+    """
+    Block until path has kept the same size for interval seconds. Returns False
+    if it disappears. With settled=True a file untouched for interval seconds is
+    taken as complete without waiting, so a large backlog is not serialised.
+    """
+    try:
+        if settled and time.time() - os.path.getmtime(path) > interval:
+            return True
+    except OSError:
+        return False
+    previous_size = -1
+    while True:
+        try:
+            current_size = os.path.getsize(path)
+        except Exception:
+            return False
+        if current_size == previous_size:
+            return True
+        previous_size = current_size
+        time.sleep(interval)
+
+def wait_for_stable_directory(path, wait_time=10, check_interval=2):
+    """Block until the total size of the files under path has not changed for wait_time seconds."""
+    stable_duration = 0
+    previous_size = -1
+    while stable_duration < wait_time:
+        total_size = 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    total_size += os.path.getsize(os.path.join(root, file))
+                except Exception:
+                    pass
+        if total_size == previous_size:
+            stable_duration += check_interval
+        else:
+            stable_duration = 0
+            previous_size = total_size
+        time.sleep(check_interval)
+    return True
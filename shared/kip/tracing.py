@@ -0,0 +1,105 @@
+"""
+Per-job trace spans.
+
+Every job carries a trace context ({"trace_id", "span_id", "sent_at"}). A
+stage opens a span when it picks the job up, appends it to trace:<trace_id>
+in Redis when it is done, and hands a fresh context to the next stage.
+"""
+import json
+import logging
+import os
+import time
+import uuid
+
+from prometheus_client import Histogram
+
+logger = logging.getLogger(__name__)
+
+TRACE_TTL_SECONDS = int(os.getenv("TRACE_TTL_SECONDS", str(7 * 24 * 3600)))
+
+STAGE_LATENCY = Histogram("kip_stage_latency_seconds", "Time spent handling one job", ["stage"])
+QUEUE_WAIT = Histogram("kip_queue_wait_seconds", "Time between the upstream publish and this stage picking the job up", ["stage"])
+
+def trace_key(trace_id):
+    return f"trace:{trace_id}"
+
+class Tracer:
+    """Opens and records the spans of one stage, using its (synchronous) Redis client."""
+
+    def __init__(self, stage, redis_client):
+        self.stage = stage
+        self.redis_client = redis_client
+
+    def start_span(self, job):
+        """
+        Open a span for this stage as a child of the job's trace context, or start
+        a new trace when the job does not carry one.
+        """
+        trace = job.get("trace") or {}
+        now = time.time()
+        span = {
+            "trace_id": trace.get("trace_id") or uuid.uuid4().hex,
+            "span_id": uuid.uuid4().hex[:16],
+            "parent_span_id": trace.get("span_id"),
+            "stage": self.stage,
+            "start": now,
+            "queue_wait": now - trace["sent_at"] if trace.get("sent_at") else None,
+        }
+        if span["queue_wait"] is not None:
+            QUEUE_WAIT.labels(self.stage).observe(span["queue_wait"])
+        return span
+
+    def end_span(self, span, **attributes):
+        span["end"] = time.time()
+        span["duration"] = span["end"] - span["start"]
+        span.update(attributes)
+        STAGE_LATENCY.labels(self.stage).observe(span["duration"])
+
+    def record_spans(self, pipe, spans):
+        for span in spans:
+            key = trace_key(span["trace_id"])
+            pipe.rpush(key, json.dumps(span))
+            pipe.expire(key, TRACE_TTL_SECONDS)
+
+    def finish_span(self, span, **attributes):
+        """Record the span latency and append the span to trace:<trace_id> in Redis."""
+        self.finish_spans([span], **attributes)
+
+    def finish_spans(self, spans, **attributes):
+        """finish_span for many spans at once, written to Redis in one pipelined call."""
+        for span in spans:
+            self.end_span(span, **attributes)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            self.record_spans(pipe, spans)
+            pipe.execute()
+        except Exception as e:
+            logger.warning("Failed to record %d spans for trace %s: %s", len(spans), spans[0]["trace_id"], e)
+
+    def trace_context(self, span):
+        """
+        Trace context to embed in the payload of the next stage's job. Code that
+        holds a job back before publishing it restamps sent_at (see stamp_sent).
+        """
+        return {"trace_id": span["trace_id"], "span_id": span["span_id"], "sent_at": time.time()}
+
+class AsyncTracer(Tracer):
+    """Tracer for the asyncio services, whose Redis client is redis.asyncio."""
+
+    async def finish_span(self, span, **attributes):
+        await self.finish_spans([span], **attributes)
+
+    async def finish_spans(self, spans, **attributes):
+        for span in spans:
+            self.end_span(span, **attributes)
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            self.record_spans(pipe, spans)
+            await pipe.execute()
+        except Exception as e:
+            logger.warning("Failed to record %d spans for trace %s: %s", len(spans), spans[0]["trace_id"], e)
+
+def stamp_sent(job):
+    """Mark the job as published now, so the next stage's queue wait excludes time held back before publishing."""
+    if job.get("trace"):
+        job["trace"]["sent_at"] = time.time()
@@ -3,10 +3,19 @@ import os
 import time
 import json
 import pika
+import redis
 import shutil
 import logging
+from contextlib import contextmanager
 import hashlib
+import subprocess
+import numpy as np
 from spleeter.separator import Separator
+from prometheus_client import Counter, Histogram, start_http_server
+from kip.tracing import Tracer
+from kip.profiling import profiling_enabled, profile_artifact_path, start_profile, stop_profile
+from kip.artifacts import finalize_job, mark_consumed, register_artifacts, register_children
+from kip.scratch import release_scratch
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
@@ -15,8 +24,63 @@ RABBITMQ_HOST = "rabbitmq"
 SPLITTER_QUEUE = "splitter_jobs"
 CONVERTER_QUEUE = "converter_jobs"
 OUTPUT_DIR = "/splitter_output"
+ORIGINALS_DIR = "/originals"  # This is our flat folder for originals.
+# Must match the x-max-priority the watcher and queue services declare.
+SPLITTER_MAX_PRIORITY = int(os.getenv("SPLITTER_MAX_PRIORITY", "10"))
+COMBINER_QUEUE = "combiner_jobs"
+
+# Preview-first rendering: separate a short excerpt first and send its stems
+# straight to the combiner, then requeue the full-length render at the lowest
+# priority. The full render later replaces the preview in /music atomically.
+# It is handed to the queue service (FULL_RENDER_KEY) rather than published
+# here, so it passes the same admission control as every other job.
+PREVIEW_ENABLED = os.getenv("PREVIEW_ENABLED", "false").lower() in ("1", "true", "yes")
+PREVIEW_SECONDS = int(os.getenv("PREVIEW_SECONDS", "60"))
+PREVIEW_START = os.getenv("PREVIEW_START", "start")  # "start" or "loudest" (the loudest window, usually a chorus)
+FULL_RENDER_PRIORITY = 0
+FULL_RENDER_KEY = "full_render_requests"  # must match the queue service
 
 processed_tracks = set()
+_separator = None
+
+redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
+
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "splitter"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9003"))
+
+BYTES_READ = Counter("kip_bytes_read_total", "Bytes of audio read", ["stage"])
+BYTES_WRITTEN = Counter("kip_bytes_written_total", "Bytes of audio written", ["stage"])
+TOOL_TIME = Histogram("kip_tool_seconds", "Time spent in ffmpeg or the separation model", ["stage", "tool"])
+CACHE_HITS = Counter("kip_cache_hits_total", "Work skipped because it was already done", ["stage", "cache"])
+
+tracer = Tracer(STAGE, redis_client)
+
+@contextmanager
+def tf_profile(job):
+    """Capture TensorFlow op timings (viewable in TensorBoard's profiler) when profiling is on for this job."""
+    if not profiling_enabled(job):
+        yield
+        return
+    logdir = profile_artifact_path(job, "splitter_tf")
+    try:
+        import tensorflow as tf
+        tf.profiler.experimental.start(logdir)
+    except Exception as e:
+        logger.warning("Could not start the TensorFlow profiler: %s", e)
+        yield
+        return
+    try:
+        yield
+    finally:
+        tf.profiler.experimental.stop()
+        logger.info("Wrote TensorFlow profile to %s", logdir)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
 
 def compute_file_hash(file_path, hash_algo='md5'):
     hash_func = hashlib.new(hash_algo)
@@ -61,24 +125,162 @@ def send_converter_job(job_payload):
     except Exception as e:
         logger.error("Failed to send converter job: %s", e)
 
-def process_track(path, metadata_key):
+def get_separator():
+    """One Separator per process, so the model is loaded once rather than for every track."""
+    global _separator
+    if _separator is None:
+        _separator = Separator('spleeter:5stems')
+    return _separator
+
+def send_combiner_job(job_payload):
+    credentials = pika.PlainCredentials('admin', 'admin')
+    try:
+        connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
+        channel = connection.channel()
+        channel.queue_declare(queue=COMBINER_QUEUE, durable=True)
+        channel.basic_publish(
+            exchange='',
+            routing_key=COMBINER_QUEUE,
+            body=json.dumps(job_payload),
+            properties=pika.BasicProperties(delivery_mode=2)
+        )
+        connection.close()
+        logger.info("Sent preview job to combiner queue for: %s", job_payload.get('original_filename'))
+    except Exception as e:
+        logger.error("Failed to send combiner job: %s", e)
+
+def request_full_render(job_payload):
+    """Hand the full render to the queue service's pending index."""
+    try:
+        redis_client.rpush(FULL_RENDER_KEY, json.dumps(job_payload))
+        logger.info("Requested full render for: %s", job_payload.get('path'))
+        return True
+    except Exception as e:
+        logger.error("Failed to request full render: %s", e)
+        return False
+
+def wants_preview(job):
+    """Preview only first-pass track jobs that are long enough to gain from it; "sing next" goes straight to full."""
+    duration = job.get("duration")
+    return (job.get("preview", PREVIEW_ENABLED)
+            and job.get("render") is None
+            and job.get("priority", 0) < SPLITTER_MAX_PRIORITY
+            and not (duration and duration <= 2 * PREVIEW_SECONDS))
+
+def preview_offset(path, duration):
+    """Start of the preview excerpt: 0, or the loudest PREVIEW_SECONDS window with PREVIEW_START=loudest."""
+    if PREVIEW_START != "loudest" or not duration or duration <= PREVIEW_SECONDS:
+        return 0.0
+    try:
+        # A 4 kHz mono decode is plenty to find the loudest stretch.
+        result = subprocess.run(["ffmpeg", "-v", "error", "-i", path, "-ac", "1", "-ar", "4000", "-f", "s16le", "-"],
+                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        samples = np.frombuffer(result.stdout, dtype=np.int16).astype(np.float32)
+        seconds = len(samples) // 4000
+        energy = (samples[:seconds * 4000].reshape(seconds, 4000) ** 2).mean(axis=1)
+        window = np.convolve(energy, np.ones(PREVIEW_SECONDS), mode="valid")
+        return float(np.argmax(window))
+    except Exception as e:
+        logger.warning("Could not find the loudest section of %s; previewing from the start: %s", path, e)
+        return 0.0
+
+def render_preview(path, metadata_key, span, job):
+    """
+    Separate a PREVIEW_SECONDS excerpt and send its WAV stems straight to the
+    combiner (skipping the converter), then requeue the job for its full render.
+    Returns False if the preview could not be made.
+    """
+    job_id = job.get("job_id") or metadata_key
+    base_folder = os.path.splitext(os.path.basename(path))[0]
+    source_folder = os.path.join(OUTPUT_DIR, f"{base_folder}.preview")
+    offset = preview_offset(path, job.get("duration"))
+    try:
+        with TOOL_TIME.labels(STAGE, "spleeter").time():
+            get_separator().separate_to_file(path, OUTPUT_DIR, offset=offset, duration=PREVIEW_SECONDS,
+                                             filename_format="{filename}.preview/{instrument}.{codec}")
+        stems = [f for f in os.listdir(source_folder) if f.endswith(".wav") and f != "vocals.wav"]
+    except Exception as e:
+        logger.error("Preview separation failed for %s: %s", path, e)
+        return False
+    register_artifacts(redis_client, job_id, source_folder)
+    logger.info("Preview separation (%ds from %.0fs) complete for: %s", PREVIEW_SECONDS, offset, path)
+
+    preview_job = {
+        "render": "preview",
+        "source_folder": source_folder,
+        "stems": stems,
+        "original_filename": os.path.basename(path),
+        "original_file": path,
+        "metadata_key": metadata_key,
+        "job_id": job_id,
+        "profile": job.get("profile", False)
+    }
+    if span:
+        preview_job["trace"] = tracer.trace_context(span)
+    send_combiner_job(preview_job)
+    full_job = dict(job, render="full", priority=FULL_RENDER_PRIORITY, job_id=job_id)
+    if span:
+        full_job["trace"] = tracer.trace_context(span)
+    if not request_full_render(full_job):
+        process_track(path, metadata_key, span, full_job)
+    return True
+
+def process_track(path, metadata_key, span=None, job=None):
+    job_payload = separate_track(path, metadata_key, span, job)
+    if job_payload:
+        send_converter_job(job_payload)
+    return bool(job_payload)
+
+def process_album(path, metadata_key, span, job):
+    """
+    Split every track of an album folder. Each track runs under its own child
+    job_id, so finishing one track only releases that track's files; the album
+    folder (registered under the album's job_id) goes once every track is done.
+    Returns how many tracks were sent on downstream.
+    """
+    tracks = sorted(f for f in os.listdir(path) if f.lower().endswith(".mp3"))
+    album_id = job.get("job_id") or metadata_key
+    track_jobs = [dict(job, job_id=f"{album_id}/{index}") for index in range(len(tracks))]
+    register_children(redis_client, album_id, [track_job["job_id"] for track_job in track_jobs])
+    if not tracks:
+        finalize_job(redis_client, album_id)
+    dispatched = 0
+    for file, track_job in zip(tracks, track_jobs):
+        if process_track(os.path.join(path, file), metadata_key, span, track_job):
+            dispatched += 1
+        else:
+            # Skipped or failed: nothing downstream will finalise this track.
+            finalize_job(redis_client, track_job["job_id"])
+    return dispatched
+
+def separate_track(path, metadata_key, span=None, job=None, output_dir=None, copy_original=True):
+    """
+    Split one track into stems under output_dir (OUTPUT_DIR by default) and
+    return the converter job for it, or None if the track was skipped or failed.
+    With copy_original=False the track is read in place instead of being
+    copied to ORIGINALS_DIR first (bulk mode).
+    """
+    job = job or {}
+    output_dir = output_dir or OUTPUT_DIR
     logger.info("Processing track: %s", path)
     abs_path = os.path.abspath(path)
     if abs_path in processed_tracks:
         logger.info("Track %s already processed; skipping.", path)
-        return
+        CACHE_HITS.labels(STAGE, "processed_tracks").inc()
+        return None
 
-    originals_dir = "/originals"  # This is our flat folder for originals.
-    os.makedirs(originals_dir, exist_ok=True)
     original_filename = os.path.basename(path)
-    destination_path = os.path.join(originals_dir, original_filename)
+    destination_path = os.path.join(ORIGINALS_DIR, original_filename)
 
+    if not copy_original:
+        original_copy = path
     # Check if the file is already in the originals folder.
-    if os.path.abspath(path) == os.path.abspath(destination_path):
+    elif os.path.abspath(path) == os.path.abspath(destination_path):
         logger.info("Source and destination are identical; using existing file.")
         original_copy = path
     else:
         try:
+            os.makedirs(ORIGINALS_DIR, exist_ok=True)
             shutil.copy2(path, destination_path)
             logger.info("Copied original file to: %s", destination_path)
             original_copy = destination_path
@@ -96,18 +298,25 @@ def process_track(path, metadata_key):
             logger.error("Failed to compute metadata_key for %s: %s", original_copy, e)
 
     try:
-        separator = Separator('spleeter:5stems')
-        separator.separate_to_file(path, OUTPUT_DIR)
+        separator = get_separator()
+        BYTES_READ.labels(STAGE).inc(file_size(path))
+        with TOOL_TIME.labels(STAGE, "spleeter").time(), tf_profile(job):
+            separator.separate_to_file(path, output_dir)
         logger.info("Stem separation complete for: %s", path)
     except Exception as e:
         logger.error("Stem separation failed for %s: %s", path, e)
-        return
+        return None
 
     base_folder = os.path.splitext(original_filename)[0]
-    source_folder = os.path.join(OUTPUT_DIR, base_folder)
+    source_folder = os.path.join(output_dir, base_folder)
+    # Never register a file that was read in place: the GC would delete it.
+    artifacts = [original_copy, source_folder] if copy_original else [source_folder]
+    register_artifacts(redis_client, job.get("job_id") or metadata_key, *artifacts)
     stems = []
     try:
         for file in os.listdir(source_folder):
+            if file.endswith(".wav"):
+                BYTES_WRITTEN.labels(STAGE).inc(file_size(os.path.join(source_folder, file)))
             if file.endswith(".wav") and file != "vocals.wav":
                 stems.append(file)
     except Exception as e:
@@ -122,38 +331,59 @@ def process_track(path, metadata_key):
         "stems": stems,
         "original_filename": original_filename,
         "original_file": original_copy,
-        "metadata_key": metadata_key
+        "metadata_key": metadata_key,
+        "job_id": job.get("job_id") or metadata_key,
+        "profile": job.get("profile", False)
     }
-    send_converter_job(job_payload)
+    if job.get("render"):
+        job_payload["render"] = job["render"]
+    if span:
+        job_payload["trace"] = tracer.trace_context(span)
+    return job_payload
 
 def callback(ch, method, properties, body):
+    span = None
+    profiler = None
+    job = {}
+    attributes = {}
     try:
         job = json.loads(body.decode())
+        mark_consumed(redis_client, job.get("job_id"))
+        span = tracer.start_span(job)
+        profiler = start_profile(job)
         logger.info("Received job: %s - %s", job.get("type").upper(), job.get("path"))
         metadata_key = job.get("metadata_key")
         job_type = job.get("type").lower()
         path = job.get("path")
         if job_type == "track" and os.path.isfile(path):
-            process_track(path, metadata_key)
+            if not (wants_preview(job) and render_preview(path, metadata_key, span, job)):
+                process_track(path, metadata_key, span, job)
         elif job_type == "album":
             if os.path.isdir(path):
-                for file in os.listdir(path):
-                    if file.lower().endswith(".mp3"):
-                        process_track(os.path.join(path, file), metadata_key)
+                # The queue's status lookup counts finished tracks against this.
+                attributes["tracks"] = process_album(path, metadata_key, span, job)
             elif os.path.isfile(path):
                 logger.info("Album job received as file; treating as track: %s", path)
-                process_track(path, metadata_key)
+                process_track(path, metadata_key, span, job)
             else:
                 logger.warning("Unknown or invalid job type or path: %s", job)
         else:
             logger.warning("Unknown or invalid job type or path: %s", job)
         ch.basic_ack(delivery_tag=method.delivery_tag)
+        tracer.finish_span(span, path=path, **attributes)
     except Exception as e:
         logger.error("Error processing job: %s", e)
+        if span:
+            tracer.finish_span(span, error=str(e))
         try:
             ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
         except Exception as nack_err:
             logger.error("Error sending nack: %s", nack_err)
+    finally:
+        # This job's stems are on disk (or never will be): admission control
+        # now sees them in the free space instead of in the reservation.
+        release_scratch(redis_client, job)
+        stop_profile(profiler, job, STAGE)
 
 def run():
     credentials = pika.PlainCredentials('admin', 'admin')
@@ -161,7 +391,7 @@ def run():
         try:
             connection = connect_to_rabbitmq_with_retries(RABBITMQ_HOST, credentials)
             channel = connection.channel()
-            channel.queue_declare(queue=SPLITTER_QUEUE, durable=True)
+            channel.queue_declare(queue=SPLITTER_QUEUE, durable=True, arguments={"x-max-priority": SPLITTER_MAX_PRIORITY})
             channel.basic_qos(prefetch_count=1)
             channel.basic_consume(queue=SPLITTER_QUEUE, on_message_callback=callback)
             logger.info("Splitter started consuming from queue.")
@@ -175,4 +405,5 @@ def run():
             time.sleep(5)
 
 if __name__ == "__main__":
+    start_http_server(METRICS_PORT)
     run()
@@ -5,10 +5,24 @@ import shutil
 import json
 import hashlib
 import logging
+import threading
+import subprocess
+import random
+import collections
+from concurrent.futures import ThreadPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from mutagen.easyid3 import EasyID3
+from mutagen.mp3 import MP3
 import redis
+from prometheus_client import Counter, start_http_server
+from kip.tracing import Tracer, stamp_sent
+from kip.profiling import start_profile, stop_profile
+from kip.artifacts import register_artifacts
+from kip.scratch import release_scratch, reserve_scratch
+from kip.stability import wait_for_stable_directory, wait_for_stable_file
+from kip.admission import (ADMISSION_POLL_SECONDS, SPLITTER_MAX_PRIORITY, PendingIndex, compute_job_priority,
+                           estimate_scratch_bytes)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
@@ -17,11 +31,60 @@ WATCH_DIR = "/downloads"
 ORIGINALS_DIR = "/originals"  # New flat folder for originals
 RABBITMQ_HOST = "rabbitmq"
 PROCESSING_QUEUE = "splitter_jobs"
+METADATA_QUEUE = "metadata_jobs"
 STABILITY_TIME = 10  # seconds
 
+# Admission control and shortest-job-first priorities live in kip.admission,
+# shared with the queue service.
+PENDING_INDEX_FILE = os.getenv("PENDING_INDEX_FILE", "/originals/.watcher_pending.json")
+SERVICE_NAME = "watcher"
+
+# Backfill: every handled file is moved out of /downloads, so whatever is still
+# there on startup (and every RESCAN_SECONDS) was dropped while the watcher was
+# down, lost to an inotify overflow, or claimed but not yet moved when the
+# watcher crashed. The only handled files left behind are those that could not
+# be moved; IN_PLACE_KEY maps their paths to the size and mtime they had when
+# handled, so a rescan can skip them with a stat instead of reading them.
+IN_PLACE_KEY = "watcher_left_in_place"
+SCAN_WORKERS = int(os.getenv("SCAN_WORKERS", "8"))
+RESCAN_SECONDS = int(os.getenv("RESCAN_SECONDS", "3600"))  # 0 disables periodic rescans
+
+# Acoustic-fingerprint dedup: a new file whose Chromaprint fingerprint matches
+# an already-produced instrumental is re-tagged from that output instead of
+# being separated again. Fingerprints live in fingerprint:<metadata_key> and are
+# indexed by bit-sampling LSH: FINGERPRINT_BANDS band keys (fpband:<band>:<bits>)
+# per track, so a lookup reads those sets for each alignment it tries in one
+# pipelined round trip and then runs a bit-error comparison on the few candidates.
+MUSIC_DIR = "/music"
+FINGERPRINT_ENABLED = os.getenv("FINGERPRINT_ENABLED", "true").lower() in ("1", "true", "yes")
+FINGERPRINT_SECONDS = 120  # audio fingerprinted from the start of each track
+FINGERPRINT_BANDS = int(os.getenv("FINGERPRINT_BANDS", "48"))
+FINGERPRINT_BAND_BITS = 12  # fingerprint bits sampled per band key
+FINGERPRINT_INDEX_WORDS = 480  # bits are sampled from the first ~60 s
+FINGERPRINT_MIN_HITS = int(os.getenv("FINGERPRINT_MIN_HITS", "2"))  # shared bands to become a candidate
+FINGERPRINT_CANDIDATES = 10
+FINGERPRINT_MAX_OFFSET = 2  # sub-fingerprints (~0.12 s each) of misalignment to try
+FINGERPRINT_MATCH_THRESHOLD = float(os.getenv("FINGERPRINT_MATCH_THRESHOLD", "0.85"))
+FINGERPRINT_MAX_DURATION_DELTA = 5  # seconds
+
 # Connect to Redis
 redis_client = redis.StrictRedis(host=os.getenv("REDIS_HOST", "redis"), port=6379, decode_responses=True)
 
+# Metrics are served on METRICS_PORT (see the reserved ports in .env.example).
+STAGE = "watcher"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9001"))
+
+BYTES_READ = Counter("kip_bytes_read_total", "Bytes of audio read", ["stage"])
+CACHE_HITS = Counter("kip_cache_hits_total", "Work skipped because it was already done", ["stage", "cache"])
+
+tracer = Tracer(STAGE, redis_client)
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
 def compute_file_hash(file_path, hash_algo='md5'):
     hash_func = hashlib.new(hash_algo)
     with open(file_path, 'rb') as f:
@@ -38,6 +101,13 @@ def extract_metadata(file_path):
         logger.warning("Failed to extract metadata from %s: %s", file_path, e)
         return {}
 
+def get_track_duration(file_path):
+    try:
+        return MP3(file_path).info.length
+    except Exception as e:
+        logger.warning("Failed to read duration from %s: %s", file_path, e)
+        return None
+
 def store_metadata(metadata_key, metadata):
     try:
         # Store each field in Redis under key: metadata:<metadata_key>
@@ -48,6 +118,114 @@ def store_metadata(metadata_key, metadata):
     except Exception as e:
         logger.error("Error storing metadata for key %s: %s", metadata_key, e)
 
+def compute_fingerprint(file_path):
+    """Raw Chromaprint fingerprint (via fpcalc) as (duration, [sub-fingerprints]), or None."""
+    try:
+        result = subprocess.run(["fpcalc", "-raw", "-json", "-length", str(FINGERPRINT_SECONDS), file_path],
+                                capture_output=True, text=True, check=True)
+        data = json.loads(result.stdout)
+        return float(data["duration"]), [int(v) & 0xFFFFFFFF for v in data["fingerprint"]]
+    except Exception as e:
+        logger.warning("Could not fingerprint %s: %s", file_path, e)
+        return None
+
+def fingerprint_similarity(a, b):
+    """Share of matching bits between two fingerprints at their best alignment (0.0 to 1.0)."""
+    best = 0.0
+    for offset in range(-FINGERPRINT_MAX_OFFSET, FINGERPRINT_MAX_OFFSET + 1):
+        pairs = list(zip(a[max(offset, 0):], b[max(-offset, 0):]))
+        if len(pairs) < min(len(a), len(b)) // 2:
+            continue
+        errors = sum((x ^ y).bit_count() for x, y in pairs)
+        best = max(best, 1.0 - errors / (32.0 * len(pairs)))
+    return best
+
+# Fixed seed: every watcher must derive the same band keys for the same audio.
+# Positions start past FINGERPRINT_MAX_OFFSET so every shifted lookup stays in range.
+_band_rng = random.Random(0x6B6970)
+FINGERPRINT_BAND_SAMPLES = [
+    [(_band_rng.randrange(FINGERPRINT_MAX_OFFSET, FINGERPRINT_INDEX_WORDS), _band_rng.randrange(32))
+     for _ in range(FINGERPRINT_BAND_BITS)]
+    for _ in range(FINGERPRINT_BANDS)
+]
+
+def fingerprint_bands(fingerprint, shift=0):
+    """
+    LSH band keys of a fingerprint: each band reads FINGERPRINT_BAND_BITS fixed
+    (sub-fingerprint, bit) positions, so two aligned fingerprints with a bit
+    error rate p share a band with probability (1 - p) ** FINGERPRINT_BAND_BITS.
+    shift reads the positions that many sub-fingerprints later. Bands reaching
+    past the end of a short fingerprint are left out.
+    """
+    keys = []
+    for band, samples in enumerate(FINGERPRINT_BAND_SAMPLES):
+        bits = 0
+        for word, bit in samples:
+            if word + shift >= len(fingerprint):
+                break
+            bits = bits << 1 | (fingerprint[word + shift] >> bit) & 1
+        else:
+            keys.append(f"fpband:{band}:{bits:x}")
+    return keys
+
+def fingerprint_candidates(fingerprint):
+    """
+    Metadata keys of indexed tracks sharing at least FINGERPRINT_MIN_HITS bands
+    with this fingerprint at one of the alignments fingerprint_similarity tries,
+    most shared bands first.
+    """
+    shifted_bands = [fingerprint_bands(fingerprint, shift)
+                     for shift in range(-FINGERPRINT_MAX_OFFSET, FINGERPRINT_MAX_OFFSET + 1)]
+    pipe = redis_client.pipeline(transaction=False)
+    for band_keys in shifted_bands:
+        for band_key in band_keys:
+            pipe.smembers(band_key)
+    results = iter(pipe.execute())
+    hits = collections.Counter()
+    for band_keys in shifted_bands:
+        shift_hits = collections.Counter()
+        for _ in band_keys:
+            shift_hits.update(next(results))
+        for key, count in shift_hits.items():
+            hits[key] = max(hits[key], count)
+    return [key for key, count in hits.most_common(FINGERPRINT_CANDIDATES) if count >= FINGERPRINT_MIN_HITS]
+
+def find_fingerprint_match(duration, fingerprint):
+    """
+    Return (metadata_key, output) of an already-produced instrumental that
+    sounds like this fingerprint, or None.
+    """
+    candidates = fingerprint_candidates(fingerprint)
+    if not candidates:
+        return None
+    pipe = redis_client.pipeline(transaction=False)
+    for key in candidates:
+        pipe.hgetall(f"fingerprint:{key}")
+    for key, stored in zip(candidates, pipe.execute()):
+        output = stored.get("output")
+        if not output or not os.path.exists(output):
+            continue  # still in the pipeline, or the instrumental was removed
+        if abs(float(stored.get("duration", 0)) - duration) > FINGERPRINT_MAX_DURATION_DELTA:
+            continue
+        similarity = fingerprint_similarity(fingerprint, [int(v) for v in stored["fp"].split(",")])
+        if similarity >= FINGERPRINT_MATCH_THRESHOLD:
+            logger.info("Fingerprint matches %s (similarity %.2f)", key, similarity)
+            return key, output
+    return None
+
+def index_fingerprint(metadata_key, duration, fingerprint):
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(f"fingerprint:{metadata_key}", mapping={
+            "duration": duration,
+            "fp": ",".join(str(v) for v in fingerprint)
+        })
+        for band_key in fingerprint_bands(fingerprint):
+            pipe.sadd(band_key, metadata_key)
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Failed to index fingerprint for %s: %s", metadata_key, e)
+
 def send_job(queue, job_payload):
     import pika
     try:
@@ -55,18 +233,111 @@ def send_job(queue, job_payload):
         parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
         connection = pika.BlockingConnection(parameters)
         channel = connection.channel()
-        channel.queue_declare(queue=queue, durable=True)
+        arguments = {"x-max-priority": SPLITTER_MAX_PRIORITY} if queue == PROCESSING_QUEUE else None
+        channel.queue_declare(queue=queue, durable=True, arguments=arguments)
+        stamp_sent(job_payload)
         body = json.dumps(job_payload)
         channel.basic_publish(
             exchange='',
             routing_key=queue,
             body=body,
-            properties=pika.BasicProperties(delivery_mode=2)
+            properties=pika.BasicProperties(delivery_mode=2, priority=job_payload.get("priority", 0))
         )
         connection.close()
         logger.info("Sent job to %s: %s", queue, job_payload)
+        return True
     except Exception as e:
         logger.error("Failed to send job to %s: %s", queue, e)
+        return False
+
+def connect_to_rabbitmq():
+    import pika
+    credentials = pika.PlainCredentials('admin', 'admin')
+    parameters = pika.ConnectionParameters(host=RABBITMQ_HOST, credentials=credentials)
+    return pika.BlockingConnection(parameters)
+
+def publish_jobs(jobs):
+    """Send released jobs to the splitter one by one; returns how many were sent."""
+    published = 0
+    for job in jobs:
+        # Reserve first, so the splitter can never release a reservation before it exists.
+        reserve_scratch(redis_client, job, estimate_scratch_bytes(job.get("duration")))
+        if not send_job(PROCESSING_QUEUE, job):
+            release_scratch(redis_client, job)
+            break
+        published += 1
+    return published
+
+pending_index = PendingIndex(PENDING_INDEX_FILE, SERVICE_NAME, redis_client, connect_to_rabbitmq, publish_jobs)
+
+class IngestClaims:
+    """Paths being handled right now, so a live event and a backfill scan never handle the same file twice."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_progress = set()
+
+    def claim(self, path):
+        """Mark path as being handled; False if another thread already is."""
+        with self.lock:
+            if path in self.in_progress:
+                return False
+            self.in_progress.add(path)
+            return True
+
+    def unclaim(self, path):
+        with self.lock:
+            self.in_progress.discard(path)
+
+    def is_claimed(self, path):
+        with self.lock:
+            return path in self.in_progress
+
+ingest_claims = IngestClaims()
+
+def file_stamp(size, mtime):
+    return f"{size}:{mtime}"
+
+def mark_left_in_place(path, target_path):
+    """Remember a handled file that is still in WATCH_DIR so the backfill does not handle it again."""
+    if target_path != path:
+        return
+    try:
+        st = os.stat(path)
+        redis_client.hset(IN_PLACE_KEY, path, file_stamp(st.st_size, st.st_mtime))
+    except Exception as e:
+        logger.warning("Failed to record %s as handled: %s", path, e)
+
+def list_directory(path):
+    """(path, is_dir, size, mtime) for each subfolder and .mp3 directly under path."""
+    entries = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    entries.append((entry.path, True, 0, 0))
+                elif entry.name.lower().endswith(".mp3") and entry.is_file():
+                    st = entry.stat()
+                    entries.append((entry.path, False, st.st_size, st.st_mtime))
+    except OSError as e:
+        logger.warning("Could not scan %s: %s", path, e)
+    return entries
+
+def scan_tree(root):
+    """Stat every .mp3 under root, listing each level's folders in parallel; returns {path: (size, mtime)}."""
+    found = {}
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        level = [root]
+        while level:
+            next_level = []
+            for entries in pool.map(list_directory, level):
+                for path, is_dir, size, mtime in entries:
+                    if is_dir:
+                        next_level.append(path)
+                    else:
+                        found[path] = (size, mtime)
+            level = next_level
+    return found
 
 class DownloadHandler(FileSystemEventHandler):
     def on_created(self, event):
@@ -75,54 +346,95 @@ class DownloadHandler(FileSystemEventHandler):
         else:
             self.handle_file(event.src_path)
 
-    def handle_file(self, path):
+    def handle_file(self, path, settled=False):
         logger.info("Detected new file: %s", path)
-        if self.is_file_stable(path):
-            os.makedirs(ORIGINALS_DIR, exist_ok=True)
-            # Compute canonical name using metadata (if available)
-            try:
-                meta = EasyID3(path)
-                title = meta.get("title", ["Unknown Title"])[0].strip()
-                artist = meta.get("artist", ["Unknown Artist"])[0].strip()
-                canonical_name = f"{title} - {artist}.mp3"
-            except Exception:
-                canonical_name = os.path.basename(path)
-            target_path = os.path.join(ORIGINALS_DIR, canonical_name)
-            try:
-                shutil.move(path, target_path)
-                logger.info("Moved file to originals: %s", target_path)
-            except Exception as e:
-                logger.error("Error moving file %s to originals: %s", path, e)
-                target_path = path
-
-            # Compute a metadata key (e.g. file hash)
-            file_hash = compute_file_hash(target_path)
-            # Extract metadata and store it in Redis
-            metadata = extract_metadata(target_path)
-            store_metadata(file_hash, metadata)
-
-            job = {
-                "type": "track",
-                "path": target_path,
-                "metadata_key": file_hash
-            }
-            send_job(PROCESSING_QUEUE, job)
-
-    def is_file_stable(self, path):
-        previous_size = -1
-        while True:
+        if not ingest_claims.claim(path):
+            logger.info("Already handling %s; skipping.", path)
+            return
+        try:
+            self.ingest_file(path, settled)
+        finally:
+            ingest_claims.unclaim(path)
+
+    def ingest_file(self, path, settled):
+        if wait_for_stable_file(path, STABILITY_TIME, settled):
+            span = tracer.start_span({})
+            profiler = start_profile({})
+            job = {}
             try:
-                current_size = os.path.getsize(path)
-            except Exception:
-                return False
-            if current_size == previous_size:
-                return True
-            previous_size = current_size
-            time.sleep(STABILITY_TIME)
+                os.makedirs(ORIGINALS_DIR, exist_ok=True)
+                # Compute canonical name using metadata (if available)
+                try:
+                    meta = EasyID3(path)
+                    title = meta.get("title", ["Unknown Title"])[0].strip()
+                    artist = meta.get("artist", ["Unknown Artist"])[0].strip()
+                    canonical_name = f"{title} - {artist}.mp3"
+                except Exception:
+                    canonical_name = os.path.basename(path)
+                target_path = os.path.join(ORIGINALS_DIR, canonical_name)
+                try:
+                    shutil.move(path, target_path)
+                    logger.info("Moved file to originals: %s", target_path)
+                except Exception as e:
+                    logger.error("Error moving file %s to originals: %s", path, e)
+                    target_path = path
+
+                # Compute a metadata key (e.g. file hash)
+                file_hash = compute_file_hash(target_path)
+                register_artifacts(redis_client, file_hash, target_path)
+                BYTES_READ.labels(STAGE).inc(file_size(target_path))
+                # Extract metadata and store it in Redis
+                metadata = extract_metadata(target_path)
+                store_metadata(file_hash, metadata)
+                duration = get_track_duration(target_path)
+
+                fingerprint = compute_fingerprint(target_path) if FINGERPRINT_ENABLED else None
+                match = None
+                if fingerprint:
+                    try:
+                        match = find_fingerprint_match(*fingerprint)
+                    except Exception as e:
+                        logger.warning("Fingerprint lookup failed for %s: %s", target_path, e)
+                if match:
+                    # Same recording as an existing instrumental: skip separation and
+                    # let the metadata stage copy that output and tag it for this file.
+                    CACHE_HITS.labels(STAGE, "fingerprint").inc()
+                    reuse_job = {
+                        "original_file": target_path,
+                        "original_filename": os.path.basename(target_path),
+                        "metadata_key": file_hash,
+                        "reuse_from": match[1],
+                        "early": False,
+                        "job_id": file_hash,
+                        "trace": tracer.trace_context(span)
+                    }
+                    tracer.finish_span(span, path=target_path, job_id=file_hash, reused=match[0])
+                    job = reuse_job
+                    send_job(METADATA_QUEUE, reuse_job)
+                    mark_left_in_place(path, target_path)
+                    return
+                if fingerprint:
+                    index_fingerprint(file_hash, *fingerprint)
+
+                job = {
+                    "type": "track",
+                    "path": target_path,
+                    "metadata_key": file_hash,
+                    "job_id": file_hash,
+                    "duration": duration,
+                    "priority": compute_job_priority(duration),
+                    "trace": tracer.trace_context(span)
+                }
+                tracer.finish_span(span, path=target_path, job_id=file_hash)
+            finally:
+                stop_profile(profiler, job, STAGE)
+            pending_index.add(job)
+            mark_left_in_place(path, target_path)
+            pending_index.release()
 
     def handle_directory(self, path):
         logger.info("Detected new folder: %s", path)
-        if self.is_directory_stable(path):
+        if wait_for_stable_directory(path):
             for root, _, files in os.walk(path):
                 for file in files:
                     if file.lower().endswith(".mp3"):
@@ -134,35 +446,51 @@ class DownloadHandler(FileSystemEventHandler):
             except Exception as e:
                 logger.error("Error removing folder %s: %s", path, e)
 
-    def is_directory_stable(self, path, wait_time=10, check_interval=2):
-        stable_duration = 0
-        previous_size = -1
-        while stable_duration < wait_time:
-            total_size = 0
-            for root, _, files in os.walk(path):
-                for file in files:
-                    try:
-                        total_size += os.path.getsize(os.path.join(root, file))
-                    except Exception:
-                        pass
-            if total_size == previous_size:
-                stable_duration += check_interval
-            else:
-                stable_duration = 0
-                previous_size = total_size
-            time.sleep(check_interval)
-        return True
+    def backfill(self):
+        """Handle every file still in WATCH_DIR that is not being handled and was not handled in place."""
+        started = time.monotonic()
+        # Read before the scan, so every entry whose file still exists shows up in it.
+        try:
+            left_in_place = redis_client.hgetall(IN_PLACE_KEY)
+        except Exception as e:
+            logger.warning("Could not read %s; rescanning files handled in place: %s", IN_PLACE_KEY, e)
+            left_in_place = {}
+        found = scan_tree(WATCH_DIR)
+        gone = [path for path in left_in_place if path not in found]
+        if gone:
+            try:
+                redis_client.hdel(IN_PLACE_KEY, *gone)
+            except Exception as e:
+                logger.warning("Failed to forget %d removed files in %s: %s", len(gone), IN_PLACE_KEY, e)
+        present = [path for path in sorted(found) if not ingest_claims.is_claimed(path)]
+        # A file edited or replaced since it was handled no longer matches its stamp and is handled again.
+        changed = [path for path in present if left_in_place.get(path) != file_stamp(*found[path])]
+        logger.info("Backfill scan of %s: %d files, %d not yet handled (%.2fs).",
+                    WATCH_DIR, len(present), len(changed), time.monotonic() - started)
+        if changed:
+            with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+                list(pool.map(lambda path: self.handle_file(path, settled=True), changed))
+        return len(changed)
 
 if __name__ == "__main__":
     os.makedirs(ORIGINALS_DIR, exist_ok=True)
+    start_http_server(METRICS_PORT)
     event_handler = DownloadHandler()
     observer = Observer()
     observer.schedule(event_handler, WATCH_DIR, recursive=True)
     observer.start()
     logger.info("Watching %s for new files and folders...", WATCH_DIR)
+    # Start watching before the backfill so nothing slips in between; the
+    # claims keep the two from handling the same file twice.
+    event_handler.backfill()
+    last_scan = time.monotonic()
     try:
         while True:
-            time.sleep(1)
+            time.sleep(ADMISSION_POLL_SECONDS)
+            pending_index.release()
+            if RESCAN_SECONDS and time.monotonic() - last_scan > RESCAN_SECONDS:
+                event_handler.backfill()
+                last_scan = time.monotonic()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()